@@ -0,0 +1,204 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+from typing import Callable
+
+from metrics import CF_API_LATENCY, CF_API_RETRIES, CF_API_THROTTLED, CF_RATE_LIMIT_WAIT
+import tracing
+
+logger = logging.getLogger('dns-manager')
+
+# Priority lanes, lower values are served first
+LANE_HIGH = 0     # Removing routes of containers that went away
+LANE_NORMAL = 1   # Changes from container events
+LANE_BULK = 2     # Full listings and startup or gap reconciliation
+LANE_NAMES = {LANE_HIGH: 'high', LANE_NORMAL: 'normal', LANE_BULK: 'bulk'}
+
+# Cloudflare allows 1200 requests per five minutes per user
+DEFAULT_RATE = 1200 / 300
+DEFAULT_BURST = 100
+
+class TokenBucket:
+    """Thread-safe token bucket that hands out tokens by priority.
+
+    Tokens refill at `rate` per second up to `burst`; a `rate` of 0 disables
+    the limit. While a caller in a higher priority lane is waiting, lower
+    lanes do not get a token, so a burst of bulk calls cannot delay deletes
+    queued behind it.
+    """
+
+    def __init__(self, rate: float = DEFAULT_RATE, burst: int = DEFAULT_BURST):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._waiting = dict.fromkeys(LANE_NAMES, 0)
+        self._cond = threading.Condition()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * max(0.0, self.rate))
+        self._updated = now
+
+    def _delay(self, lane: int) -> float:
+        """Take a token and return 0, or return how long to wait before trying again."""
+        now = time.monotonic()
+        self._refill(now)
+        if now < self._paused_until:
+            return self._paused_until - now
+        if self.rate <= 0:
+            return 0.0
+        if any(count for other, count in self._waiting.items() if other < lane):
+            # Re-checked whenever a token is taken or a waiter leaves
+            return 1.0 / self.rate
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0.0
+        return (1 - self._tokens) / self.rate
+
+    def acquire(self, lane: int = LANE_NORMAL) -> float:
+        """Block until a token is available in `lane`; return the seconds waited."""
+        started = time.monotonic()
+        with self._cond:
+            delay = self._delay(lane)
+            if delay:
+                self._waiting[lane] += 1
+                try:
+                    while delay:
+                        self._cond.wait(delay)
+                        delay = self._delay(lane)
+                finally:
+                    self._waiting[lane] -= 1
+                    self._cond.notify_all()
+        return time.monotonic() - started
+
+    async def acquire_async(self, lane: int = LANE_NORMAL) -> float:
+        """Like `acquire`, but sleeps on the event loop instead of blocking."""
+        started = time.monotonic()
+        while True:
+            with self._cond:
+                delay = self._delay(lane)
+                if not delay:
+                    break
+            await asyncio.sleep(delay)
+        return time.monotonic() - started
+
+    def pause(self, seconds: float) -> None:
+        """Hand out no tokens for `seconds`, e.g. after Cloudflare returned a 429."""
+        with self._cond:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = min(self._tokens, 0.0)
+
+    def available(self) -> float:
+        """Number of tokens currently in the bucket."""
+        with self._cond:
+            self._refill(time.monotonic())
+            return self._tokens
+
+def _retry_after(error: Exception):
+    """Return the Retry-After of an API error in seconds, if Cloudflare sent one."""
+    response = getattr(error, 'response', None)
+    try:
+        return float(response.headers.get('retry-after'))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+class ApiClient:
+    """Shared wrapper for Cloudflare SDK calls.
+
+    Every call takes a token from the bucket in its priority lane, and its
+    latency is recorded by operation and outcome. Rate-limited calls (429)
+    are never processed by Cloudflare, so they are always retried after
+    pausing the whole bucket. Server errors and connection failures are
+    retried for every call: a create that went through before the error is
+    found by the manager on retry and turned into an edit. Retries use
+    full-jitter exponential backoff.
+    """
+
+    def __init__(self, bucket: TokenBucket = None, max_retries: int = 5,
+                 retry_min_delay: float = 1.0, retry_max_delay: float = 60.0):
+        self.bucket = bucket or TokenBucket()
+        self.max_retries = max_retries
+        self.retry_min_delay = retry_min_delay
+        self.retry_max_delay = retry_max_delay
+
+    def _retry_delay(self, operation: str, error: Exception, attempt: int):
+        """Return how long to wait before retrying after `error`, or None to give up."""
+        if attempt >= self.max_retries:
+            return None
+        # Imported here so that importing this module does not load the SDK
+        from cloudflare import APIConnectionError, APIStatusError, RateLimitError
+
+        backoff = random.uniform(0, min(self.retry_max_delay, self.retry_min_delay * 2 ** attempt))
+        if isinstance(error, RateLimitError):
+            CF_API_THROTTLED.inc(operation=operation)
+            delay = _retry_after(error) or backoff
+            self.bucket.pause(delay)
+            reason = 'rate_limited'
+        elif isinstance(error, APIConnectionError):
+            delay, reason = backoff, 'connection'
+        elif isinstance(error, APIStatusError) and error.status_code >= 500:
+            delay, reason = backoff, 'server_error'
+        else:
+            return None
+
+        CF_API_RETRIES.inc(operation=operation, reason=reason)
+        logger.warning(
+            f"Cloudflare {operation} failed ({reason}), retry {attempt + 1}/{self.max_retries} "
+            f"in {delay:.1f}s: {str(error)}"
+        )
+        return delay
+
+    def call(self, operation: str, call: Callable, lane: int = LANE_NORMAL, **kwargs):
+        """Call the SDK function `call` with rate limiting and retries."""
+        with tracing.span(f'cloudflare {operation}', operation=operation, lane=LANE_NAMES[lane], retries=0) as span:
+            attempt = 0
+            waited = 0.0
+            while True:
+                wait = self.bucket.acquire(lane)
+                CF_RATE_LIMIT_WAIT.observe(wait, lane=LANE_NAMES[lane])
+                waited += wait
+                span.set_attribute('rate_limit_wait_seconds', round(waited, 3))
+                started = time.monotonic()
+                outcome = 'error'
+                try:
+                    result = call(**kwargs)
+                    outcome = 'success'
+                    return result
+                except Exception as e:
+                    delay = self._retry_delay(operation, e, attempt)
+                    if delay is None:
+                        raise
+                finally:
+                    CF_API_LATENCY.observe(time.monotonic() - started, operation=operation, outcome=outcome)
+                attempt += 1
+                span.set_attribute('retries', attempt)
+                time.sleep(delay)
+
+    async def call_async(self, operation: str, call: Callable, lane: int = LANE_NORMAL, **kwargs):
+        """Await the SDK coroutine function `call` with rate limiting and retries."""
+        with tracing.span(f'cloudflare {operation}', operation=operation, lane=LANE_NAMES[lane], retries=0) as span:
+            attempt = 0
+            waited = 0.0
+            while True:
+                wait = await self.bucket.acquire_async(lane)
+                CF_RATE_LIMIT_WAIT.observe(wait, lane=LANE_NAMES[lane])
+                waited += wait
+                span.set_attribute('rate_limit_wait_seconds', round(waited, 3))
+                started = time.monotonic()
+                outcome = 'error'
+                try:
+                    result = await call(**kwargs)
+                    outcome = 'success'
+                    return result
+                except Exception as e:
+                    delay = self._retry_delay(operation, e, attempt)
+                    if delay is None:
+                        raise
+                finally:
+                    CF_API_LATENCY.observe(time.monotonic() - started, operation=operation, outcome=outcome)
+                attempt += 1
+                span.set_attribute('retries', attempt)
+                await asyncio.sleep(delay)
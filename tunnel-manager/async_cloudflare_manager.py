@@ -0,0 +1,254 @@
+import asyncio
+import logging
+import random
+import time
+from cloudflare import AsyncCloudflare, BadRequestError, ConflictError, NotFoundError
+from cloudflare.types.zero_trust.tunnels.configuration_get_response import ConfigurationGetResponse
+from api_client import ApiClient, LANE_BULK, LANE_NORMAL
+from cloudflare_manager import DNS_PAGE_SIZE, CloudflareManagerBase, DnsChange
+from dns_record_index import summarize
+from label_schema import ContainerLabels
+from metrics import TUNNEL_PUSHES
+import tracing
+
+logger = logging.getLogger('dns-manager')
+
+class AsyncCloudflareManager(CloudflareManagerBase):
+    """asyncio variant of CloudflareManager built on AsyncCloudflare.
+
+    Independent DNS writes run concurrently, bounded by `max_concurrency`
+    in-flight API calls, and the tunnel configuration fetch and push overlap
+    with the DNS work. Planning and cache handling are shared with the sync
+    manager through CloudflareManagerBase.
+    """
+
+    def __init__(self, api_token, account_id, tunnel_token, zone_id, domain, host_ip='localhost',
+                 dns_refresh_interval=3600, max_concurrency=8, api_client: ApiClient = None,
+                 push_conflict_retries: int = 3):
+        super().__init__(
+            api_token, account_id, tunnel_token, zone_id, domain,
+            host_ip=host_ip, dns_refresh_interval=dns_refresh_interval
+        )
+        self.max_concurrency = max_concurrency
+        self._semaphore = None
+        self.api = api_client or ApiClient()
+        self.push_conflict_retries = push_conflict_retries
+
+        # Retries are handled by the rate-limit aware ApiClient, not the SDK
+        self.cf = AsyncCloudflare(api_token=api_token, max_retries=0)
+        logger.info("Successfully initialized async Cloudflare client")
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        # Created lazily so it binds to the running event loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    async def _api(self, operation: str, call, lane: int = LANE_NORMAL, **kwargs):
+        """Await a Cloudflare SDK call under the concurrency limit and the shared rate limit."""
+        async with self.semaphore:
+            return await self.api.call_async(operation, call, lane=lane, **kwargs)
+
+    async def _iter_dns_records(self, lane: int = LANE_BULK, **params):
+        """Yield DNS records page by page, fetching each page through the rate-limited client."""
+        params.setdefault('per_page', DNS_PAGE_SIZE)
+        page = await self._api('dns.records.list', self.cf.dns.records.list, lane=lane, **params)
+        while True:
+            for record in page.result:
+                yield record
+            if not page.has_next_page():
+                return
+            page = await self._api('dns.records.list', page.get_next_page, lane=lane)
+
+    async def initialize(self) -> None:
+        """Fetch DNS records and the tunnel configuration concurrently."""
+        await asyncio.gather(self.get_dns_records(), self.get_tunnel_config())
+
+    async def close(self) -> None:
+        await self.cf.close()
+
+    async def get_dns_records(self):
+        """Get all CNAME records for the domain and cache them."""
+        try:
+            records = [
+                summarize(record)
+                async for record in self._iter_dns_records(
+                    zone_id=self.zone_id,
+                    type='CNAME',
+                    name={'endswith': f'.{self.domain}'},
+                    **self.ownership.list_filters()
+                )
+            ]
+            return self._cache_dns_records(records)
+        except Exception as e:
+            logger.error(f"Error fetching DNS records: {str(e)}")
+            raise
+
+    async def refresh_dns_record(self, subdomain: str, lane: int = LANE_NORMAL):
+        """Re-read a single DNS record from Cloudflare into the local index."""
+        name = f"{subdomain}.{self.domain}"
+        record = None
+        async for r in self._iter_dns_records(lane=lane, zone_id=self.zone_id, type='CNAME', name={'exact': name}):
+            if r.name == name:
+                record = r
+                break
+        return self._index_refreshed_record(subdomain, record)
+
+    async def get_tunnel_config(self, cache: bool = True) -> ConfigurationGetResponse:
+        """Get current tunnel configuration and, unless `cache` is False, cache it."""
+        try:
+            config = await self._api(
+                'zero_trust.tunnels.configurations.get', self.cf.zero_trust.tunnels.configurations.get,
+                account_id=self.account_id,
+                tunnel_id=self.tunnel_id
+            )
+            if cache:
+                self._cache_tunnel_config(config)
+            return config
+        except Exception as e:
+            logger.error(f"Error getting tunnel configuration: {str(e)}")
+            raise
+
+    def _ensure_tunnel_config(self) -> None:
+        if not self.tunnel_config_cache:
+            raise RuntimeError("Tunnel configuration has not been fetched yet")
+
+    @tracing.traced('tunnel push')
+    async def push_tunnel_config(self) -> None:
+        """Push the cached tunnel configuration to Cloudflare, merging remote changes first."""
+        try:
+            if not self.tunnel_config_cache:
+                logger.warning("No tunnel configuration cache to push")
+                return
+
+            logger.info("Pushing tunnel configuration to Cloudflare")
+            for attempt in range(self.push_conflict_retries + 1):
+                remote = await self.get_tunnel_config(cache=False)
+                config, pushed = self._prepare_push(remote)
+                try:
+                    result = await self._api(
+                        'zero_trust.tunnels.configurations.update', self.cf.zero_trust.tunnels.configurations.update,
+                        account_id=self.account_id,
+                        tunnel_id=self.tunnel_id,
+                        config=config
+                    )
+                except ConflictError:
+                    if attempt == self.push_conflict_retries:
+                        raise
+                    self._count_push_conflict(attempt)
+                    await asyncio.sleep(random.uniform(0.1, 0.5))
+                    continue
+                self._finish_push(remote, result, pushed)
+                break
+
+            logger.info("Successfully pushed tunnel configuration")
+            TUNNEL_PUSHES.inc(outcome='success')
+
+        except Exception as e:
+            TUNNEL_PUSHES.inc(outcome='error')
+            logger.error(f"Error pushing tunnel configuration: {str(e)}")
+            raise
+
+    @tracing.traced('dns update')
+    async def update_dns_record(self, labels: ContainerLabels, action: str = 'start') -> bool:
+        """Update the DNS records of the subdomains of a container, concurrently."""
+        subdomain = ','.join(labels.subdomains)
+        try:
+            if not labels.enabled:
+                logger.debug("Cannot update DNS record: not enabled in labels")
+                return False
+
+            changes = self.plan_dns_changes(labels, action)
+            tracing.current_span().set_attribute('change', ','.join(change.action for change in changes) or None)
+            await asyncio.gather(*(self.apply_dns_change(change) for change in changes))
+            return bool(changes)
+
+        except Exception as e:
+            logger.error("Error updating DNS record for %s: %s", subdomain, e, extra={'subdomain': subdomain})
+            raise
+
+    @tracing.traced('dns apply')
+    async def apply_dns_change(self, change: DnsChange, lane: int = None) -> None:
+        """Write a planned DNS change to Cloudflare and update the index."""
+        lane = self._start_dns_change(change, lane)
+        operation, call, kwargs = self._dns_call(change)
+        try:
+            record = await self._api(operation, call, lane=lane, **kwargs)
+        except NotFoundError:
+            if change.action == 'create':
+                raise
+            change, record = self._missing_record_change(change), None
+            if change.action == 'create':
+                operation, call, kwargs = self._dns_call(change)
+                record = await self._api(operation, call, lane=lane, **kwargs)
+        except (BadRequestError, ConflictError):
+            if change.action != 'create':
+                raise
+            current_record = await self.refresh_dns_record(change.subdomain, lane=lane)
+            if current_record is None:
+                raise
+            change = self._existing_record_change(change, current_record)
+            if change is None:
+                return
+            operation, call, kwargs = self._dns_call(change)
+            record = await self._api(operation, call, lane=lane, **kwargs)
+        self._finish_dns_change(change, record)
+
+    async def reconcile(self, updates: list) -> dict:
+        """Apply a batch of (labels, action) container updates concurrently.
+
+        DNS writes for different subdomains run in parallel while the tunnel
+        configuration is fetched, updated and pushed once for the whole
+        batch. Returns a summary of the work done.
+        """
+        started = time.monotonic()
+
+        # Only the last update per set of subdomains matters
+        latest = {}
+        for labels, action in updates:
+            if labels.enabled:
+                latest[labels.subdomains] = (labels, action)
+
+        config_task = None
+        if not self.tunnel_config_cache:
+            config_task = asyncio.create_task(self.get_tunnel_config())
+        if self.dns_record_cache.is_stale():
+            await self.get_dns_records()
+
+        dns_tasks = [
+            asyncio.create_task(self.update_dns_record(labels, action))
+            for labels, action in latest.values()
+        ]
+
+        push_task = None
+        try:
+            if config_task:
+                await config_task
+            tunnel_changed = [
+                self.update_tunnel_config(labels, action)
+                for labels, action in latest.values()
+            ]
+            if any(tunnel_changed):
+                push_task = asyncio.create_task(self.push_tunnel_config())
+        finally:
+            results = await asyncio.gather(*dns_tasks, return_exceptions=True)
+            if push_task:
+                await push_task
+
+        errors = [r for r in results if isinstance(r, Exception)]
+        summary = {
+            'containers': len(latest),
+            'dns_changes': sum(1 for r in results if r is True),
+            'tunnel_pushed': push_task is not None,
+            'errors': len(errors),
+            'seconds': round(time.monotonic() - started, 3),
+        }
+        logger.info(
+            f"Reconciled {summary['containers']} containers in {summary['seconds']}s: "
+            f"{summary['dns_changes']} DNS changes, {summary['errors']} errors, "
+            f"tunnel config {'pushed' if summary['tunnel_pushed'] else 'unchanged'}"
+        )
+        if errors:
+            raise errors[0]
+        return summary
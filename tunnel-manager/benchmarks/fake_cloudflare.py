@@ -0,0 +1,210 @@
+import itertools
+import random
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime, timezone
+
+import httpx
+from cloudflare import InternalServerError, NotFoundError, BadRequestError, RateLimitError
+from cloudflare.types.zero_trust.tunnels.configuration_get_response import (
+    ConfigurationGetResponse,
+    Config,
+    ConfigIngress
+)
+
+class FakeRecord:
+    """DNS record with the attributes the managers read from SDK records."""
+
+    def __init__(self, id, name, content, proxied=True, ttl=1, comment=None, type='CNAME'):
+        self.id = id
+        self.name = name
+        self.type = type
+        self.content = content
+        self.proxied = proxied
+        self.ttl = ttl
+        self.comment = comment
+        self.modified_on = datetime.now(timezone.utc)
+
+    def copy(self) -> 'FakeRecord':
+        record = FakeRecord(self.id, self.name, self.content, self.proxied, self.ttl, self.comment, self.type)
+        record.modified_on = self.modified_on
+        return record
+
+class FakePaginator:
+    """One page of a listing, navigated like the SDK's paginators; each further page counts as an API call."""
+
+    def __init__(self, api: 'FakeCloudflare', items: list, per_page: int, page: int = 1):
+        self._api = api
+        self._items = items
+        self._per_page = per_page
+        self._page = page
+        self.result = items[(page - 1) * per_page:page * per_page]
+
+    def has_next_page(self) -> bool:
+        return self._page * self._per_page < len(self._items)
+
+    def get_next_page(self) -> 'FakePaginator':
+        self._api._request('dns.records.list')
+        return FakePaginator(self._api, self._items, self._per_page, self._page + 1)
+
+    def __iter__(self):
+        page = self
+        while True:
+            yield from page.result
+            if not page.has_next_page():
+                return
+            page = page.get_next_page()
+
+class _Namespace:
+    pass
+
+class FakeCloudflare:
+    """In-process stand-in for the Cloudflare DNS records and tunnel configuration APIs.
+
+    Every request sleeps for `latency` seconds, counts towards a sliding
+    window rate limit of `rate_limit` requests per `rate_window` seconds
+    (answered with 429) and fails with a 500 with probability `error_rate`.
+    """
+
+    def __init__(self, latency: float = 0.0, rate_limit: int = None, rate_window: float = 300.0,
+                 error_rate: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.error_rate = error_rate
+        self.calls = Counter()
+        self.rejected = Counter()
+        self._random = random.Random(seed)
+        self._recent = deque()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self.records = {}
+        self.config_version = 1
+        self.ingress = [ConfigIngress.construct(hostname=None, service='http_status:404', path=None)]
+
+        self.dns = _Namespace()
+        self.dns.records = _Namespace()
+        self.dns.records.list = self._list_records
+        self.dns.records.create = self._create_record
+        self.dns.records.edit = self._edit_record
+        self.dns.records.delete = self._delete_record
+
+        self.zero_trust = _Namespace()
+        self.zero_trust.tunnels = _Namespace()
+        self.zero_trust.tunnels.configurations = _Namespace()
+        self.zero_trust.tunnels.configurations.get = self._get_config
+        self.zero_trust.tunnels.configurations.update = self._update_config
+
+    def seed_records(self, names, content: str, comment: str = None) -> None:
+        """Pre-populate the zone with CNAME records."""
+        for name in names:
+            record_id = str(next(self._ids))
+            self.records[record_id] = FakeRecord(record_id, name, content, comment=comment)
+
+    @property
+    def total_calls(self) -> int:
+        return sum(self.calls.values())
+
+    def _error(self, cls, status: int, message: str, headers: dict = None):
+        request = httpx.Request('GET', 'https://api.cloudflare.com/client/v4/fake')
+        return cls(message, response=httpx.Response(status, headers=headers, request=request), body=None)
+
+    def _request(self, operation: str) -> None:
+        with self._lock:
+            self.calls[operation] += 1
+            now = time.monotonic()
+            if self.rate_limit:
+                while self._recent and now - self._recent[0] > self.rate_window:
+                    self._recent.popleft()
+                if len(self._recent) >= self.rate_limit:
+                    self.rejected['rate_limited'] += 1
+                    retry_after = self.rate_window - (now - self._recent[0])
+                    raise self._error(RateLimitError, 429, 'Rate limited', {'Retry-After': f'{retry_after:.3f}'})
+                self._recent.append(now)
+            fail = self.error_rate and self._random.random() < self.error_rate
+        if self.latency:
+            time.sleep(self.latency)
+        if fail:
+            with self._lock:
+                self.rejected['server_error'] += 1
+            raise self._error(InternalServerError, 500, 'Injected server error')
+
+    @staticmethod
+    def _matches(value, condition) -> bool:
+        if condition is None:
+            return True
+        if isinstance(condition, str):
+            return value == condition
+        value = value or ''
+        return all(
+            (op == 'exact' and value == arg)
+            or (op == 'startswith' and value.startswith(arg))
+            or (op == 'endswith' and value.endswith(arg))
+            or (op == 'contains' and arg in value)
+            for op, arg in condition.items()
+        )
+
+    def _list_records(self, zone_id=None, type=None, search=None, name=None, content=None, comment=None,
+                      per_page=100, **kwargs):
+        self._request('dns.records.list')
+        with self._lock:
+            items = [
+                record.copy() for record in self.records.values()
+                if (not type or record.type == type)
+                and (not search or search in record.name)
+                and self._matches(record.name, name)
+                and self._matches(record.content, content)
+                and self._matches(record.comment, comment)
+            ]
+        return FakePaginator(self, items, per_page)
+
+    def _create_record(self, zone_id=None, name=None, content=None, proxied=True, ttl=1, comment=None, type='CNAME', **kwargs):
+        self._request('dns.records.create')
+        with self._lock:
+            if any(record.name == name for record in self.records.values()):
+                raise self._error(BadRequestError, 400, 'A CNAME record with that host already exists')
+            record_id = str(next(self._ids))
+            record = FakeRecord(record_id, name, content, proxied, ttl, comment, type)
+            self.records[record_id] = record
+            return record.copy()
+
+    def _edit_record(self, dns_record_id=None, zone_id=None, **fields):
+        self._request('dns.records.edit')
+        with self._lock:
+            record = self.records.get(dns_record_id)
+            if record is None:
+                raise self._error(NotFoundError, 404, 'Record not found')
+            for field, value in fields.items():
+                setattr(record, field, value)
+            record.modified_on = datetime.now(timezone.utc)
+            return record.copy()
+
+    def _delete_record(self, dns_record_id=None, zone_id=None, **kwargs):
+        self._request('dns.records.delete')
+        with self._lock:
+            if self.records.pop(dns_record_id, None) is None:
+                raise self._error(NotFoundError, 404, 'Record not found')
+
+    def _config_response(self) -> ConfigurationGetResponse:
+        return ConfigurationGetResponse.construct(
+            config=Config.construct(ingress=list(self.ingress)),
+            version=self.config_version,
+            source='cloudflare'
+        )
+
+    def _get_config(self, account_id=None, tunnel_id=None, **kwargs):
+        self._request('zero_trust.tunnels.configurations.get')
+        with self._lock:
+            return self._config_response()
+
+    def _update_config(self, account_id=None, tunnel_id=None, config=None, **kwargs):
+        self._request('zero_trust.tunnels.configurations.update')
+        ingress = config.get('ingress') if isinstance(config, dict) else config.ingress
+        with self._lock:
+            self.ingress = [
+                ConfigIngress.construct(**rule) if isinstance(rule, dict) else rule
+                for rule in ingress or []
+            ]
+            self.config_version += 1
+            return self._config_response()
@@ -0,0 +1,131 @@
+import itertools
+import queue
+import time
+from collections import Counter
+
+class FakeContainer:
+    """Container with the attributes DockerManager reads from docker-py containers."""
+
+    def __init__(self, id: str, name: str, labels: dict, host_port: str = None):
+        self.id = id
+        self.name = name
+        self.labels = labels
+        self.ports = {'80/tcp': [{'HostIp': '0.0.0.0', 'HostPort': host_port}]} if host_port else {}
+
+class _Containers:
+    def __init__(self, client: 'FakeDockerClient'):
+        self._client = client
+
+    def list(self):
+        self._client.calls['containers.list'] += 1
+        return list(self._client.running.values())
+
+    def get(self, container_id: str):
+        self._client.calls['containers.get'] += 1
+        container = self._client.all.get(container_id)
+        if container is None:
+            import docker
+            raise docker.errors.NotFound(f"No such container: {container_id}")
+        return container
+
+class FakeEventStream:
+    """Blocking event stream like docker-py's CancellableStream."""
+
+    def __init__(self, events: queue.Queue):
+        self._events = events
+
+    def __iter__(self):
+        while True:
+            event = self._events.get()
+            if event is None:
+                return
+            yield event
+
+    def close(self) -> None:
+        self._events.put(None)
+
+class FakeDockerClient:
+    """In-process stand-in for a Docker daemon with synthetic container events.
+
+    With `stream`, events are also delivered to `events()` streams opened
+    before they were created; `since` is not replayed, so a bounded
+    `until` query returns no events.
+    """
+
+    def __init__(self, stream: bool = False):
+        self.containers = _Containers(self)
+        self.calls = Counter()
+        self.all = {}
+        self.running = {}
+        self._ids = itertools.count(1)
+        self._streams = [] if stream else None
+
+    def create_container(self, name: str, subdomain: str = None, port: str = None,
+                         host_port: str = None, enabled: bool = True) -> FakeContainer:
+        labels = {'com.docker.compose.service': name}
+        if enabled:
+            labels['cloudflare.enabled'] = 'true'
+            if subdomain:
+                labels['cloudflare.subdomain'] = subdomain
+            if port:
+                labels['cloudflare.port'] = port
+        container_id = f'{next(self._ids):064x}'
+        container = FakeContainer(container_id, name, labels, host_port=host_port)
+        self.all[container_id] = container
+        return container
+
+    def event(self, container: FakeContainer, action: str) -> dict:
+        """Build a container event the way the daemon reports it."""
+        now = time.time_ns()
+        if action == 'start':
+            self.running[container.id] = container
+        elif action == 'die':
+            self.running.pop(container.id, None)
+        event = {
+            'Type': 'container',
+            'Action': action,
+            'id': container.id,
+            'Actor': {'ID': container.id, 'Attributes': {'name': container.name, **container.labels}},
+            'time': now // 10**9,
+            'timeNano': now,
+        }
+        for events in self._streams or ():
+            events.put(event)
+        return event
+
+    def events(self, decode: bool = True, filters: dict = None, since: str = None,
+               until: str = None) -> FakeEventStream:
+        if self._streams is None:
+            raise RuntimeError("FakeDockerClient was created without stream=True")
+        self.calls['events'] += 1
+        events = queue.Queue()
+        if until is not None:
+            events.put(None)
+        else:
+            self._streams.append(events)
+        return FakeEventStream(events)
+
+    def compose_up(self, count: int, prefix: str = 'svc', explicit_port: bool = True) -> list:
+        """Start `count` labelled containers and return their start events."""
+        events = []
+        for i in range(count):
+            container = self.create_container(
+                f'{prefix}-{i}',
+                subdomain=f'{prefix}{i}',
+                port=str(8000 + i) if explicit_port else None,
+                host_port=str(8000 + i)
+            )
+            events.append(self.event(container, 'start'))
+        return events
+
+    def compose_down(self) -> list:
+        """Stop every running container and return their die events."""
+        return [self.event(container, 'die') for container in list(self.running.values())]
+
+    def flapping(self, container: FakeContainer, cycles: int) -> list:
+        """Return `cycles` die/start pairs for a crash-looping container."""
+        events = []
+        for _ in range(cycles):
+            events.append(self.event(container, 'die'))
+            events.append(self.event(container, 'start'))
+        return events
@@ -0,0 +1,207 @@
+"""Offline benchmarks for the tunnel manager.
+
+Runs the real CloudflareManager, DockerManager and reconciler against the
+in-process FakeCloudflare and FakeDockerClient, and writes a JSON report.
+
+Usage (from the tunnel-manager directory):
+    python -m benchmarks.run --sizes 10,100,1000 --latency 0.02 --output bench-report.json
+"""
+import argparse
+import base64
+import json
+import logging
+import platform
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+from api_client import ApiClient, TokenBucket
+from cloudflare_manager import CloudflareManager
+from docker_manager import DockerManager, replaces_pending
+from reconciler import reconcile
+from benchmarks.fake_cloudflare import FakeCloudflare
+from benchmarks.fake_docker import FakeDockerClient
+
+TUNNEL_ID = 'bench-tunnel'
+DOMAIN = 'bench.example.com'
+
+def tunnel_token(tunnel_id: str = TUNNEL_ID) -> str:
+    return base64.b64encode(json.dumps({'t': tunnel_id}).encode()).decode()
+
+def make_managers(args, fake_cf: FakeCloudflare, fake_docker: FakeDockerClient):
+    cf_manager = CloudflareManager(
+        api_token='bench',
+        account_id='bench-account',
+        tunnel_token=tunnel_token(),
+        zone_id='bench-zone',
+        domain=DOMAIN,
+        push_quiet_window=args.push_quiet_window,
+        push_max_delay=args.push_max_delay,
+        api_client=ApiClient(
+            TokenBucket(rate=args.client_rate_limit / 300, burst=args.client_burst),
+            max_retries=args.max_retries,
+            retry_min_delay=0.05
+        ),
+        client=fake_cf
+    )
+    docker_manager = DockerManager(event_workers=args.workers, client=fake_docker)
+    return cf_manager, docker_manager
+
+def drain(docker_manager: DockerManager, cf_manager: CloudflareManager, events: list) -> None:
+    """Push events through the manager's queue and workers and wait until applied."""
+    docker_manager.start_workers(cf_manager.handle_container_update)
+    for event in events:
+        docker_manager.event_queue.put(
+            docker_manager.event_key(event), (docker_manager, event), replace=replaces_pending
+        )
+    while True:
+        stats = docker_manager.event_queue.stats()
+        if not stats['depth'] and not stats['in_flight']:
+            break
+        time.sleep(0.005)
+    cf_manager.flush_tunnel_config()
+
+def measure(name: str, size: int, fake_cf: FakeCloudflare, run) -> dict:
+    """Run a scenario step, recording wall time, API calls and peak memory."""
+    calls_before = fake_cf.calls.copy()
+    rejected_before = fake_cf.rejected.copy()
+    tracemalloc.start()
+    started = time.perf_counter()
+    error = None
+    try:
+        events = run() or 0
+    except Exception as e:
+        events, error = 0, str(e)
+    seconds = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    calls = fake_cf.calls - calls_before
+    api_calls = sum(calls.values())
+    return {
+        'scenario': name,
+        'containers': size,
+        'events': events,
+        'seconds': round(seconds, 4),
+        'events_per_sec': round(events / seconds, 1) if events and seconds else None,
+        'api_calls': api_calls,
+        'api_calls_per_event': round(api_calls / events, 3) if events else None,
+        'calls_by_operation': dict(calls),
+        'tunnel_pushes': calls.get('zero_trust.tunnels.configurations.update', 0),
+        'rejected': dict(fake_cf.rejected - rejected_before),
+        'peak_memory_kb': round(peak / 1024, 1),
+        'error': error,
+    }
+
+def run_size(args, size: int) -> list:
+    results = []
+    fake_cf = FakeCloudflare(
+        latency=args.latency,
+        rate_limit=args.rate_limit,
+        rate_window=args.rate_window,
+        error_rate=args.error_rate,
+        seed=args.seed
+    )
+    # Unrelated records in the zone that listings have to page through
+    fake_cf.seed_records(
+        (f'other{i}.{DOMAIN}' for i in range(args.unmanaged_records)),
+        content='origin.example.net'
+    )
+    fake_docker = FakeDockerClient()
+    # Startup: containers already running, state fetched and reconciled in one batch
+    fake_docker.compose_up(size, prefix='boot')
+    managers = []
+
+    def startup():
+        if not managers:
+            managers.extend(make_managers(args, fake_cf, fake_docker))
+        cf_manager, docker_manager = managers
+        containers = docker_manager.get_running_containers()
+        reconcile(
+            cf_manager,
+            [docker_manager.get_container_labels(c) for c in containers],
+            max_workers=args.reconcile_workers
+        )
+    results.append(measure('startup_reconcile', size, fake_cf, startup))
+    cf_manager, docker_manager = managers
+
+    try:
+        # Reconcile again with nothing changed (e.g. after an event gap): no writes expected
+        results.append(measure('reconcile_unchanged', size, fake_cf, startup))
+
+        # docker compose up of a new stack
+        def compose_up():
+            events = fake_docker.compose_up(size, prefix='up', explicit_port=False)
+            drain(docker_manager, cf_manager, events)
+            return len(events)
+        results.append(measure('compose_up_storm', size, fake_cf, compose_up))
+
+        # docker compose down of everything
+        def compose_down():
+            events = fake_docker.compose_down()
+            drain(docker_manager, cf_manager, events)
+            return len(events)
+        results.append(measure('compose_down_storm', size, fake_cf, compose_down))
+
+        # A few crash-looping containers
+        def flapping():
+            events = []
+            for i in range(min(size, 5)):
+                container = fake_docker.create_container(f'flap-{i}', subdomain=f'flap{i}', port='80')
+                events.append(fake_docker.event(container, 'start'))
+                events.extend(fake_docker.flapping(container, args.flap_cycles))
+            drain(docker_manager, cf_manager, events)
+            return len(events)
+        results.append(measure('restart_flapping', size, fake_cf, flapping))
+
+    finally:
+        docker_manager.stop()
+        cf_manager.close()
+
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='10,100,1000', help='comma-separated container counts')
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds per fake API request')
+    parser.add_argument('--rate-limit', type=int, default=None, help='requests the fake API allows per window')
+    parser.add_argument('--rate-window', type=float, default=300.0, help='seconds in the fake rate limit window')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='probability of an injected 500')
+    parser.add_argument('--unmanaged-records', type=int, default=200, help='unrelated records in the zone')
+    parser.add_argument('--client-rate-limit', type=float, default=0,
+                        help='client request budget per five minutes (CF_RATE_LIMIT, 0 disables)')
+    parser.add_argument('--client-burst', type=int, default=100, help='client burst size (CF_RATE_BURST)')
+    parser.add_argument('--max-retries', type=int, default=5, help='client retries (CF_MAX_RETRIES)')
+    parser.add_argument('--workers', type=int, default=4, help='event worker threads')
+    parser.add_argument('--reconcile-workers', type=int, default=8, help='startup reconcile threads')
+    parser.add_argument('--push-quiet-window', type=float, default=0.2)
+    parser.add_argument('--push-max-delay', type=float, default=2.0)
+    parser.add_argument('--flap-cycles', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='bench-report.json', help='path of the JSON report')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+
+    scenarios = []
+    for size in (int(s) for s in args.sizes.split(',') if s):
+        scenarios.extend(run_size(args, size))
+        for result in scenarios[-5:]:
+            print(
+                f"{result['scenario']:<28} n={result['containers']:<5} {result['seconds']:>8.3f}s "
+                f"calls={result['api_calls']:<6} events/s={result['events_per_sec']} "
+                f"peak={result['peak_memory_kb']}KB"
+            )
+
+    report = {
+        'generated_at': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'parameters': vars(args),
+        'scenarios': scenarios,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {args.output}")
+
+if __name__ == '__main__':
+    main()
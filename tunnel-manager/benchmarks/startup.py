@@ -0,0 +1,168 @@
+"""Import-time and startup-time benchmarks for the tunnel manager.
+
+Measures how long importing the entry point and the Cloudflare manager
+takes in a fresh interpreter, and how soon after `main.start()` container
+events are read and applied, against the in-process FakeCloudflare and
+FakeDockerClient.
+
+Usage (from the tunnel-manager directory):
+    python -m benchmarks.startup --records 1000 --latency 0.05 --output startup-report.json
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+import main
+from api_client import ApiClient, TokenBucket
+from ownership import MANAGED_COMMENT
+from benchmarks.fake_cloudflare import FakeCloudflare
+from benchmarks.fake_docker import FakeDockerClient
+from benchmarks.run import DOMAIN, TUNNEL_ID, tunnel_token
+
+IMPORT_SNIPPET = (
+    "import sys, time; started = time.perf_counter(); import {module}; "
+    "print(time.perf_counter() - started, 'cloudflare' in sys.modules)"
+)
+
+def measure_import(module: str, repeat: int) -> dict:
+    """Import `module` in `repeat` fresh interpreters and report the median time."""
+    directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    seconds, loads_sdk = [], None
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, '-c', IMPORT_SNIPPET.format(module=module)],
+            cwd=directory, capture_output=True, text=True, check=True
+        ).stdout.split()
+        seconds.append(float(output[0]))
+        loads_sdk = output[1] == 'True'
+    return {
+        'module': module,
+        'median_seconds': round(statistics.median(seconds), 4),
+        'min_seconds': round(min(seconds), 4),
+        'imports_cloudflare_sdk': loads_sdk,
+    }
+
+def measure_startup(args) -> dict:
+    """Start the manager once and time when events are read and applied."""
+    fake_cf = FakeCloudflare(latency=args.latency)
+    fake_docker = FakeDockerClient(stream=True)
+    fake_docker.compose_up(args.records, prefix='app')
+    fake_cf.seed_records(
+        (f'app{i}.{DOMAIN}' for i in range(args.records)),
+        content=f'{TUNNEL_ID}.cfargotunnel.com',
+        comment=MANAGED_COMMENT
+    )
+    fake_cf.seed_records(
+        (f'other{i}.{DOMAIN}' for i in range(args.unmanaged_records)),
+        content='origin.example.net'
+    )
+
+    # Emit an event as soon as the manager starts watching
+    watching = threading.Event()
+    open_stream = fake_docker.events
+
+    def events(**kwargs):
+        stream = open_stream(**kwargs)
+        watching.set()
+        return stream
+
+    fake_docker.events = events
+    late = fake_docker.create_container('late', subdomain='late', port='8080')
+    timings = {}
+    started = time.perf_counter()
+
+    def emit():
+        watching.wait()
+        timings['watching_seconds'] = time.perf_counter() - started
+        fake_docker.event(late, 'start')
+
+    emitter = threading.Thread(target=emit, daemon=True)
+    emitter.start()
+
+    shard_config = {
+        'name': 'default',
+        'api_token': 'bench',
+        'account_id': 'bench-account',
+        'tunnel_token': tunnel_token(),
+        'zone_id': 'bench-zone',
+        'domain': DOMAIN,
+        'host_ip': 'localhost',
+    }
+    api_clients = {'default': ApiClient(TokenBucket(rate=0, burst=1), retry_min_delay=0.05)}
+    router, docker_fleet, drift_reconcilers = main.start(
+        [shard_config], api_clients, cf_client=fake_cf, docker_clients={'local': fake_docker}
+    )
+    timings['ready_seconds'] = time.perf_counter() - started
+    try:
+        emitter.join()
+        deadline = time.monotonic() + 60
+        while not any(record.name == f'late.{DOMAIN}' for record in list(fake_cf.records.values())):
+            if time.monotonic() > deadline:
+                raise TimeoutError("The event emitted during startup was never applied")
+            time.sleep(0.001)
+        timings['first_event_seconds'] = time.perf_counter() - started
+    finally:
+        for drift_reconciler in drift_reconcilers:
+            drift_reconciler.stop()
+        docker_fleet.stop()
+        router.close()
+
+    return {
+        'records': args.records,
+        **{name: round(value, 4) for name, value in timings.items()},
+        'api_calls': sum(fake_cf.calls.values()),
+        'calls_by_operation': dict(fake_cf.calls),
+    }
+
+def main_(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--records', type=int, default=1000, help='running containers with existing records')
+    parser.add_argument('--unmanaged-records', type=int, default=200, help='unrelated records in the zone')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds per fake API request')
+    parser.add_argument('--repeat', type=int, default=5, help='runs of each measurement')
+    parser.add_argument('--output', default='startup-report.json', help='path of the JSON report')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    os.environ['STATE_FILE'] = ''
+    os.environ.setdefault('DRIFT_CHECK_INTERVAL', '0')
+
+    imports = [measure_import(module, args.repeat) for module in ('main', 'cloudflare_manager')]
+    for result in imports:
+        print(
+            f"import {result['module']:<20} {result['median_seconds']:>8.4f}s "
+            f"(min {result['min_seconds']:.4f}s) loads SDK: {result['imports_cloudflare_sdk']}"
+        )
+
+    runs = [measure_startup(args) for _ in range(args.repeat)]
+    startup = {
+        name: round(statistics.median(run[name] for run in runs), 4)
+        for name in ('watching_seconds', 'ready_seconds', 'first_event_seconds')
+    }
+    print(
+        f"startup n={args.records:<6} watching {startup['watching_seconds']:.4f}s  "
+        f"ready {startup['ready_seconds']:.4f}s  first event applied {startup['first_event_seconds']:.4f}s"
+    )
+
+    report = {
+        'generated_at': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'parameters': vars(args),
+        'imports': imports,
+        'startup': startup,
+        'runs': runs,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {args.output}")
+
+if __name__ == '__main__':
+    main_()
@@ -2,34 +2,74 @@ import os
 import json
 import base64
 import logging
-from cloudflare import Cloudflare
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from cloudflare import Cloudflare, BadRequestError, ConflictError, NotFoundError
 from cloudflare.types.zero_trust.tunnels.configuration_get_response import (
     ConfigurationGetResponse,
     Config,
-    ConfigIngress
+    ConfigIngress,
+    ConfigIngressOriginRequest
 )
+from api_client import ApiClient, LANE_BULK, LANE_HIGH, LANE_NORMAL
+from dns_record_index import DnsRecordIndex, record_diff, summarize
+from ingress_table import IngressTable, three_way_merge
+from label_schema import ContainerLabels
+from metrics import DNS_CHANGES, DNS_FOREIGN_RECORDS, TUNNEL_CONFIG_CONFLICTS, TUNNEL_PUSHES
+from ownership import MANAGED_COMMENT, OwnershipRegistry
+from push_scheduler import PushScheduler
+from state_snapshot import StateSnapshot
+import tracing
 
 logger = logging.getLogger('dns-manager')
 
-class CloudflareManager:
-    def __init__(self, api_token, account_id, tunnel_token, zone_id, domain, host_ip='localhost'):
+# Records per page when listing DNS records; one page is held in memory at a time
+DNS_PAGE_SIZE = 1000
+
+class DnsChange:
+    """A single DNS record write planned from container labels."""
+
+    __slots__ = ('action', 'subdomain', 'record', 'data', 'fields')
+
+    def __init__(self, action: str, subdomain: str, record=None, data: dict = None, fields: tuple = ()):
+        self.action = action
+        self.subdomain = subdomain
+        self.record = record
+        self.data = data
+        self.fields = fields
+
+    def __repr__(self):
+        return f"DnsChange({self.action!r}, {self.subdomain!r})"
+
+class CloudflareManagerBase:
+    """State and decision logic shared by the sync and async managers.
+
+    Subclasses provide the Cloudflare I/O; everything here only reads and
+    mutates the local DNS record index and ingress table.
+    """
+
+    def __init__(self, api_token, account_id, tunnel_token, zone_id, domain, host_ip='localhost',
+                 dns_refresh_interval=3600):
         self.api_token = api_token
         self.account_id = account_id
         self.tunnel_token = tunnel_token
         self.zone_id = zone_id
         self.domain = domain
-        self.dns_record_cache = {}
+        self.dns_record_cache = DnsRecordIndex(refresh_interval=dns_refresh_interval)
         self.tunnel_config_cache = None
+        self.ingress_table = IngressTable()
+        # Ingress rules as last fetched from or pushed to Cloudflare
+        self._ingress_base = IngressTable()
         self.host_ip = host_ip
-        
-        # Extract tunnel ID and initialize client
+        self._config_lock = threading.RLock()
+
+        # Extract tunnel ID
         self.tunnel_id = self._get_tunnel_id_from_token()
-        self.cf = Cloudflare(api_token=api_token)
-        logger.info("Successfully initialized Cloudflare client")
-        
-        # Initialize caches
-        self.get_dns_records()
-        self.get_tunnel_config()
+
+        # Only records owned by this manager are listed, indexed, edited or deleted
+        self.ownership = OwnershipRegistry(f'{self.tunnel_id}.cfargotunnel.com')
 
     def _get_tunnel_id_from_token(self):
         """Extract tunnel ID from Cloudflare tunnel token."""
@@ -52,217 +92,654 @@ class CloudflareManager:
             logger.error(f"Failed to extract tunnel ID from token: {str(e)}")
             raise
 
+    def _cache_dns_records(self, records) -> DnsRecordIndex:
+        """Replace the DNS record index with the records for this domain.
+
+        `records` may be a generator; each record is reduced to a summary as
+        it arrives, so only the summaries are kept. Records not owned by this
+        manager are skipped.
+        """
+        suffix = f'.{self.domain}'
+        self.dns_record_cache.replace({
+            record.name[:-len(suffix)]: summarize(record)
+            for record in records
+            if record.name.endswith(suffix) and self.ownership.owns(record)
+        })
+        # Foreign records may have been removed since; re-check them when needed
+        self.ownership.forget_foreign()
+        logger.info(f"Cached {len(self.dns_record_cache)} DNS records")
+        return self.dns_record_cache
+
+    def _cache_tunnel_config(self, config: ConfigurationGetResponse) -> None:
+        """Replace the cached tunnel configuration and its ingress table."""
+        with self._config_lock:
+            self.tunnel_config_cache = config
+            self.ingress_table = IngressTable(config.config.ingress or [])
+            self._ingress_base = self.ingress_table.copy()
+        logger.info(f"Successfully cached tunnel configuration ({len(self.ingress_table)} ingress rules)")
+
+    def owns_hostname(self, hostname: str) -> bool:
+        """Return True if the hostname's DNS record carries this manager's marker."""
+        if not hostname or not hostname.endswith(f'.{self.domain}'):
+            return False
+        record = self.dns_record_cache.get(hostname[:-len(self.domain) - 1])
+        return record is not None and self.is_managed_record(record)
+
+    def merge_tunnel_config(self, remote: ConfigurationGetResponse) -> bool:
+        """Rebase local ingress changes onto a newer remote configuration.
+
+        Does nothing if the remote version is the one the local state is
+        based on. Otherwise runs a three-way merge of the last known base, the
+        local table and the remote rules, in which this manager's changes win
+        only for hostnames it owns. Returns True if the remote had changed.
+        """
+        with self._config_lock:
+            local_version = getattr(self.tunnel_config_cache, 'version', None)
+            if remote.version == local_version:
+                return False
+
+            merged, conflicts = three_way_merge(
+                self._ingress_base,
+                self.ingress_table,
+                IngressTable(remote.config.ingress or []),
+                self.owns_hostname
+            )
+            TUNNEL_CONFIG_CONFLICTS.inc(kind='remote_changed')
+            logger.info(f"Tunnel configuration changed remotely (version {local_version} -> {remote.version}), merging")
+            for hostname, path in conflicts:
+                TUNNEL_CONFIG_CONFLICTS.inc(kind='rule_conflict')
+                winner = 'local' if self.owns_hostname(hostname) else 'remote'
+                logger.warning(f"Ingress rule for {hostname}{path or ''} changed on both sides, keeping the {winner} rule")
+
+            self.tunnel_config_cache = remote
+            self.ingress_table = merged
+            self._ingress_base = IngressTable(remote.config.ingress or [])
+            return True
+
+    def _check_push_result(self, remote: ConfigurationGetResponse, result) -> None:
+        """Record a pushed configuration and warn if another writer raced the push."""
+        version = getattr(result, 'version', None)
+        if version is None:
+            return
+        if remote.version is not None and version != remote.version + 1:
+            # Someone wrote between our read and our write; the drift check repairs it
+            TUNNEL_CONFIG_CONFLICTS.inc(kind='concurrent_write')
+            logger.warning(
+                f"Tunnel configuration was written concurrently (expected version {remote.version + 1}, got {version})"
+            )
+        self.tunnel_config_cache.version = version
+
+    def _serialize_tunnel_config(self) -> Config:
+        """Write the ingress table into the cached config for pushing."""
+        self.tunnel_config_cache.config.ingress = self.ingress_table.to_list()
+        return self.tunnel_config_cache.config
+
+    def build_record_data(self, subdomain: str, labels: ContainerLabels) -> dict:
+        """Build the desired DNS record for a subdomain of a container."""
+        return {
+            'comment': MANAGED_COMMENT,
+            'content': f'{self.tunnel_id}.cfargotunnel.com',
+            'name': f"{subdomain}.{self.domain}",
+            'proxied': labels.proxied,
+            'ttl': labels.ttl,
+            'type': 'CNAME'
+        }
+
+    def build_ingress_rules(self, labels: ContainerLabels, subdomain: str = None) -> list:
+        """Build the desired ingress rules of a container, or of one of its subdomains."""
+        routes = labels.routes_for(subdomain) if subdomain else labels.routes
+        return [
+            ConfigIngress(
+                hostname=f"{route.subdomain}.{self.domain}",
+                service=route.service(self.host_ip),
+                origin_request=ConfigIngressOriginRequest(**route.origin_request) if route.origin_request else None,
+                path=route.path
+            )
+            for route in routes
+        ]
+
+    def is_foreign_hostname(self, hostname: str) -> bool:
+        """Return True if the DNS record of a hostname belongs to someone else, so its ingress rules do too."""
+        suffix = f".{self.domain}"
+        return bool(hostname) and hostname.endswith(suffix) and self.ownership.is_foreign(hostname[:-len(suffix)])
+
+    def is_managed_record(self, record) -> bool:
+        """Return True if a DNS record was created by this manager for this tunnel."""
+        return self.ownership.owns(record)
+
+    def _index_refreshed_record(self, subdomain: str, record):
+        """Store a re-read record in the index if it is owned; return it as a summary or None."""
+        if record is None:
+            self.dns_record_cache.remove(subdomain)
+            return None
+        record = summarize(record)
+        if self.ownership.owns(record):
+            self.dns_record_cache.put(subdomain, record)
+        else:
+            self.dns_record_cache.remove(subdomain)
+            self.ownership.mark_foreign(subdomain, record)
+        return record
+
+    def _skip_foreign(self, subdomain: str, record) -> bool:
+        """Return True, and log it, if an existing record belongs to someone else."""
+        if self.ownership.owns(record):
+            return False
+        DNS_FOREIGN_RECORDS.inc()
+        logger.warning(
+            "DNS record for %s.%s exists but is not managed by this manager (points at %s), leaving it alone",
+            subdomain, self.domain, getattr(record, 'content', None), extra={'subdomain': subdomain}
+        )
+        return True
+
+    def plan_dns_change(self, subdomain: str, labels: ContainerLabels, action: str = 'start', records: dict = None):
+        """Compare the desired record of a subdomain with the index and return a DnsChange, or None.
+
+        Bulk diffs pass `records`, a copy of the index, so that they do not
+        count as cache hits and misses.
+        """
+        if self.ownership.is_foreign(subdomain):
+            logger.debug("DNS record for %s.%s is not managed by this manager", subdomain, self.domain)
+            return None
+        if records is None:
+            current_record = self.dns_record_cache.get(subdomain)
+        else:
+            current_record = records.get(subdomain)
+
+        if not labels.enabled or action == 'die':
+            if current_record is None or not self.is_managed_record(current_record):
+                return None
+            return DnsChange('delete', subdomain, record=current_record)
+
+        record_data = self.build_record_data(subdomain, labels)
+        if current_record is None:
+            return DnsChange('create', subdomain, data=record_data)
+
+        changes = record_diff(current_record, record_data)
+        if not changes:
+            logger.debug("DNS record for %s.%s is up to date", subdomain, self.domain)
+            return None
+        return DnsChange('edit', subdomain, record=current_record, data=record_data, fields=tuple(changes))
+
+    def plan_dns_changes(self, labels: ContainerLabels, action: str = 'start') -> list:
+        """Plan the DNS changes for all subdomains of a container."""
+        changes = (self.plan_dns_change(subdomain, labels, action) for subdomain in labels.subdomains)
+        return [change for change in changes if change is not None]
+
+    def _start_dns_change(self, change: DnsChange, lane: int = None) -> int:
+        """Log a DNS write about to be made and return its priority lane.
+
+        Unless a `lane` is given, deletes go ahead of other writes.
+        """
+        subdomain = change.subdomain
+        name = f"{subdomain}.{self.domain}"
+        span = tracing.current_span()
+        span.set_attribute('subdomain', subdomain)
+        span.set_attribute('action', change.action)
+        if change.action == 'delete':
+            logger.info("Deleting DNS record for %s", name, extra={'subdomain': subdomain, 'action': 'delete'})
+        elif change.action == 'create':
+            logger.info("Creating new DNS record for %s", name, extra={'subdomain': subdomain, 'action': 'create'})
+        else:
+            logger.info(
+                "Updating DNS record for %s: %s", name, ', '.join(change.fields),
+                extra={'subdomain': subdomain, 'action': 'edit'}
+            )
+        if lane is None:
+            lane = LANE_HIGH if change.action == 'delete' else LANE_NORMAL
+        return lane
+
+    def _dns_call(self, change: DnsChange) -> tuple:
+        """Return the operation name, SDK method and arguments that write a DNS change."""
+        records = self.cf.dns.records
+        if change.action == 'delete':
+            return 'dns.records.delete', records.delete, {'zone_id': self.zone_id, 'dns_record_id': change.record.id}
+        if change.action == 'create':
+            return 'dns.records.create', records.create, {'zone_id': self.zone_id, **change.data}
+        return 'dns.records.edit', records.edit, {
+            'zone_id': self.zone_id, 'dns_record_id': change.record.id, **change.data
+        }
+
+    def _missing_record_change(self, change: DnsChange) -> DnsChange:
+        """Return what is left to do for a delete or edit whose record was deleted outside the manager."""
+        name = f"{change.subdomain}.{self.domain}"
+        if change.action == 'delete':
+            logger.info("DNS record for %s was already deleted", name)
+            return change
+        logger.info("DNS record for %s no longer exists, recreating", name)
+        return DnsChange('create', change.subdomain, data=change.data)
+
+    def _existing_record_change(self, change: DnsChange, current_record):
+        """Turn a create that found an existing record into an edit of it, or None if nothing is left to do."""
+        if self._skip_foreign(change.subdomain, current_record):
+            return None
+        logger.info("Adding existing DNS record for %s.%s to cache", change.subdomain, self.domain)
+        fields = tuple(record_diff(current_record, change.data))
+        if not fields:
+            return None
+        change = DnsChange('edit', change.subdomain, record=current_record, data=change.data, fields=fields)
+        self._start_dns_change(change)
+        return change
+
+    def _finish_dns_change(self, change: DnsChange, record=None) -> None:
+        """Count a written DNS change and update the index with the written record."""
+        DNS_CHANGES.inc(action=change.action)
+        if change.action == 'delete':
+            self.dns_record_cache.remove(change.subdomain)
+        else:
+            self.dns_record_cache.put(change.subdomain, record)
+
+    def _prepare_push(self, remote: ConfigurationGetResponse) -> tuple:
+        """Merge a freshly read remote configuration; return the config to push and a copy of its table."""
+        with self._config_lock:
+            self.merge_tunnel_config(remote)
+            # Serialize the ingress table into the cached config only at push time
+            return self._serialize_tunnel_config(), self.ingress_table.copy()
+
+    def _count_push_conflict(self, attempt: int) -> None:
+        TUNNEL_CONFIG_CONFLICTS.inc(kind='push_rejected')
+        tracing.current_span().set_attribute('conflict_retries', attempt + 1)
+        logger.warning("Tunnel configuration push conflicted, retrying")
+
+    def _finish_push(self, remote: ConfigurationGetResponse, result, pushed: IngressTable) -> None:
+        """Make the pushed table the base of later merges."""
+        with self._config_lock:
+            self._ingress_base = pushed
+            self._check_push_result(remote, result)
+
+    def apply_ingress_changes(self, upserts: list, removals: list) -> bool:
+        """Apply ingress rule upserts and (hostname, path) removals to the local table.
+
+        Rules of hostnames whose DNS record turned out to belong to someone
+        else, e.g. while creating it, are left alone.
+        """
+        changed = False
+        with self._config_lock:
+            self._ensure_tunnel_config()
+            for rule in upserts:
+                if not self.is_foreign_hostname(rule.hostname):
+                    changed = self.ingress_table.upsert(rule) or changed
+            for hostname, path in removals:
+                if not self.is_foreign_hostname(hostname):
+                    changed = self.ingress_table.remove(hostname, path) is not None or changed
+        return changed
+
+    def _ensure_tunnel_config(self) -> None:
+        """Make sure the tunnel configuration cache is populated."""
+        raise NotImplementedError
+
+    @tracing.traced('ingress update')
+    def update_tunnel_config(self, labels: ContainerLabels, action: str = 'start') -> bool:
+        """Update tunnel configuration cache with the routes of a container."""
+        try:
+
+            if not labels.enabled:
+                logger.debug("Cannot update tunnel config: not enabled in labels")
+                return False
+
+            changed = False
+            with self._config_lock:
+                self._ensure_tunnel_config()
+                tracing.current_span().set_attribute(
+                    'hostname', ','.join(f"{subdomain}.{self.domain}" for subdomain in labels.subdomains)
+                )
+
+                for rule in self.build_ingress_rules(labels):
+                    hostname, path = rule.hostname, rule.path
+                    route = hostname + (path or '')
+                    if self.is_foreign_hostname(hostname):
+                        logger.debug("Leaving ingress rule for %s alone, its DNS record is not managed", route)
+                        continue
+
+                    # If the container stopped, remove its ingress rules
+                    if action == 'die':
+                        if self.ingress_table.remove(hostname, path) is None:
+                            continue
+                        logger.info(
+                            "Removed ingress rule for %s", route,
+                            extra={'hostname': hostname, 'path': path, 'action': 'remove'}
+                        )
+                        changed = True
+                        continue
+
+                    # Create or update ingress rule
+                    existed = (hostname, path) in self.ingress_table
+                    if not self.ingress_table.upsert(rule):
+                        logger.debug("Ingress rule for %s is unchanged", route)
+                        continue
+                    logger.info(
+                        "%s ingress rule for %s", 'Updated' if existed else 'Added new', route,
+                        extra={'hostname': hostname, 'path': path, 'action': 'update' if existed else 'add'}
+                    )
+                    changed = True
+            return changed
+
+        except Exception as e:
+            logger.error(f"Error updating tunnel configuration cache: {str(e)}")
+            raise
+
+class CloudflareManager(CloudflareManagerBase):
+    def __init__(self, api_token, account_id, tunnel_token, zone_id, domain, host_ip='localhost',
+                 push_quiet_window=2.0, push_max_delay=10.0, dns_refresh_interval=3600,
+                 snapshot: StateSnapshot = None, api_client: ApiClient = None, client=None,
+                 push_conflict_retries: int = 3):
+        super().__init__(
+            api_token, account_id, tunnel_token, zone_id, domain,
+            host_ip=host_ip, dns_refresh_interval=dns_refresh_interval
+        )
+        self.snapshot = snapshot
+        self.api = api_client or ApiClient()
+        self.push_conflict_retries = push_conflict_retries
+        self._push_lock = threading.Lock()
+
+        # Coalesce tunnel config pushes from bursts of container events
+        self.push_scheduler = PushScheduler(
+            self.push_tunnel_config,
+            quiet_window=push_quiet_window,
+            max_delay=push_max_delay
+        )
+        
+        # Initialize client, unless one is injected (e.g. the benchmark fake).
+        # Retries are handled by the rate-limit aware ApiClient, not the SDK.
+        self.cf = client or Cloudflare(api_token=api_token, max_retries=0)
+        logger.info("Successfully initialized Cloudflare client")
+        
+        # Initialize caches, reusing the state snapshot when it is still valid
+        self._load_state()
+
+    def _load_state(self) -> None:
+        """Fetch the tunnel configuration and the DNS records, or restore them from the snapshot.
+
+        Without a usable snapshot, the DNS listing runs concurrently with the
+        tunnel configuration request.
+        """
+        state = self._load_snapshot()
+        if state is None:
+            with ThreadPoolExecutor(max_workers=1, thread_name_prefix='dns-listing') as pool:
+                listing = pool.submit(self.get_dns_records)
+                self.get_tunnel_config()
+                listing.result()
+            return
+
+        self.get_tunnel_config()
+        if not self._restore_snapshot(state):
+            self.get_dns_records()
+
+    def _load_snapshot(self):
+        """Return the saved state for this zone and tunnel, or None."""
+        if not self.snapshot:
+            return None
+        try:
+            return self.snapshot.load(self.zone_id, self.tunnel_id, self.domain)
+        except Exception as e:
+            logger.warning(f"Failed to load state snapshot: {str(e)}")
+            return None
+
+    def _restore_snapshot(self, state: dict) -> bool:
+        """Load the DNS record index from a saved state if it is still valid.
+
+        The snapshot is trusted only if the tunnel configuration version has
+        not changed since it was saved, which costs no extra API call since
+        the configuration is fetched at startup anyway.
+        """
+        try:
+            remote_version = getattr(self.tunnel_config_cache, 'version', None)
+            if remote_version != state.get('tunnel_config_version'):
+                logger.info(
+                    f"Tunnel configuration changed since snapshot "
+                    f"(version {state.get('tunnel_config_version')} -> {remote_version}), refreshing DNS records"
+                )
+                return False
+
+            # Snapshots of older versions also hold records the manager does not own
+            self.dns_record_cache.replace({
+                subdomain: record for subdomain, record in StateSnapshot.dns_records(state).items()
+                if self.ownership.owns(record)
+            }, age=state['age'])
+            self.ownership.restore_foreign(StateSnapshot.foreign_records(state))
+            logger.info(f"Restored {len(self.dns_record_cache)} DNS records from state snapshot")
+            return True
+
+        except Exception as e:
+            logger.warning(f"Failed to restore state snapshot: {str(e)}")
+            return False
+
+    def save_snapshot(self) -> None:
+        """Persist the current state for the next start, if a snapshot is configured."""
+        if not self.snapshot:
+            return
+        try:
+            self.snapshot.save(self)
+        except Exception as e:
+            logger.warning(f"Failed to save state snapshot: {str(e)}")
+
+    def _api(self, operation: str, call, lane: int = LANE_NORMAL, **kwargs):
+        """Call the Cloudflare SDK through the shared rate-limited client."""
+        return self.api.call(operation, call, lane=lane, **kwargs)
+
+    def _iter_dns_records(self, lane: int = LANE_BULK, **params):
+        """Yield DNS records page by page, fetching each page through the rate-limited client."""
+        params.setdefault('per_page', DNS_PAGE_SIZE)
+        page = self._api('dns.records.list', self.cf.dns.records.list, lane=lane, **params)
+        while True:
+            yield from page.result
+            if not page.has_next_page():
+                return
+            page = self._api('dns.records.list', page.get_next_page, lane=lane)
+
     def get_dns_records(self, search: str = None):
         """Get DNS records from Cloudflare.
         
         If search is provided, returns a single matching record.
-        Otherwise, caches and returns all CNAME records for the domain.
+        Otherwise, caches and returns the CNAME records of the domain owned
+        by this manager, filtered on the server side and streamed page by page.
         """
         try:
-            records = self.cf.dns.records.list(
-                zone_id=self.zone_id,
-                type='CNAME',
-                search=search
-            )
-
             if search:
                 # Return first matching record if searching
-                matching = [r for r in records if r.name.endswith(self.domain)]
-                return matching[0] if matching else None
-            else:
-                # Cache all domain records if not searching
-                dns_records = [
-                    record for record in records
-                    if record.name.endswith(self.domain)
-                ]
-                
-                # Update the cache
-                self.dns_record_cache = {
-                    record.name.replace(f'.{self.domain}', ''): record
-                    for record in dns_records
-                }
-                logger.info(f"Cached {len(self.dns_record_cache)} DNS records")
-                return self.dns_record_cache
+                records = self._iter_dns_records(lane=LANE_NORMAL, zone_id=self.zone_id, type='CNAME', search=search)
+                return next((summarize(r) for r in records if r.name.endswith(f'.{self.domain}')), None)
+
+            # Cache all domain records if not searching
+            return self._cache_dns_records(self._iter_dns_records(
+                zone_id=self.zone_id,
+                type='CNAME',
+                name={'endswith': f'.{self.domain}'},
+                **self.ownership.list_filters()
+            ))
 
         except Exception as e:
             logger.error(f"Error fetching DNS records: {str(e)}")
             raise
 
-    def get_tunnel_config(self) -> ConfigurationGetResponse:
-        """Get current tunnel configuration and cache it."""
+    def list_tunnel_dns_records(self) -> list:
+        """List the owned CNAME records, without touching the index."""
+        try:
+            return [
+                summarize(record)
+                for record in self._iter_dns_records(
+                    zone_id=self.zone_id,
+                    type='CNAME',
+                    **self.ownership.list_filters()
+                )
+            ]
+        except Exception as e:
+            logger.error(f"Error listing tunnel DNS records: {str(e)}")
+            raise
+
+    def get_tunnel_config(self, cache: bool = True) -> ConfigurationGetResponse:
+        """Get current tunnel configuration and, unless `cache` is False, cache it."""
         try:
-            config = self.cf.zero_trust.tunnels.configurations.get(
+            config = self._api(
+                'zero_trust.tunnels.configurations.get', self.cf.zero_trust.tunnels.configurations.get,
                 account_id=self.account_id,
                 tunnel_id=self.tunnel_id
             )
-            self.tunnel_config_cache = config
-            logger.info("Successfully cached tunnel configuration")
+            if cache:
+                self._cache_tunnel_config(config)
             return config
         except Exception as e:
             logger.error(f"Error getting tunnel configuration: {str(e)}")
             raise
 
-    def update_tunnel_config(self, labels: dict, action: str = 'start') -> None:
-        """Update tunnel configuration cache based on container labels."""
-        try:
-
-            enabled = labels.get('enabled', False)
-            if not enabled:
-                logger.debug("Cannot update tunnel config: not enabled in labels")
-                return False
-
-            if not self.tunnel_config_cache:
-                self.get_tunnel_config()
-
-            subdomain = labels.get('subdomain')
-            config = self.tunnel_config_cache
-            hostname = f"{subdomain}.{self.domain}"
-            logger.info(f"Hostname for {subdomain}: {hostname}")
-            
-            # Find existing ingress rule for this hostname
-            existing_rule = next(
-                (rule for rule in config.config.ingress 
-                 if rule.hostname == hostname),
-                None
-            )
-
-            # If container is disabled, remove the ingress rule
-            if not labels.get('enabled', True) or action == 'die':
-                if existing_rule:
-                    config.config.ingress.remove(existing_rule)
-                    logger.info(f"Removed ingress rule for {hostname}")
-            else:
-                # Create or update ingress rule
-                service = f"http://{self.host_ip}:{labels.get('port', '80')}"
-                new_rule = ConfigIngress(
-                    hostname=hostname,
-                    service=service,
-                    origin_request=None,
-                    path=None
-                )
-
-                if existing_rule:
-                    # Update existing rule cache
-                    idx = config.config.ingress.index(existing_rule)
-                    config.config.ingress[idx] = new_rule
-                    logger.info(f"Updated ingress rule for {hostname}")
-                else:
-                    # Add new rule before catch-all rule (the last rule)
-                    config.config.ingress.insert(-2, new_rule)
-                    logger.info(f"Added new ingress rule for {hostname}")
-
-            # Update local cache only
-            self.tunnel_config_cache = config
-            logger.debug(f"Updated tunnel configuration cache for {hostname}")
-
-        except Exception as e:
-            logger.error(f"Error updating tunnel configuration cache: {str(e)}")
-            raise
+    def _ensure_tunnel_config(self) -> None:
+        if not self.tunnel_config_cache:
+            self.get_tunnel_config()
 
+    @tracing.traced('tunnel push')
     def push_tunnel_config(self) -> None:
-        """Push the cached tunnel configuration to Cloudflare."""
+        """Push the cached tunnel configuration to Cloudflare.
+
+        The remote configuration is read first, and local changes are merged
+        onto it if anyone else changed it since it was last read or pushed, so
+        their rules are never overwritten with a stale copy. A push rejected
+        with a conflict is retried after a short delay.
+        """
         try:
             if not self.tunnel_config_cache:
                 logger.warning("No tunnel configuration cache to push")
                 return
 
             logger.info("Pushing tunnel configuration to Cloudflare")
-            result = self.cf.zero_trust.tunnels.configurations.update(
-                account_id=self.account_id,
-                tunnel_id=self.tunnel_id,
-                config=self.tunnel_config_cache.config
-            )
+            # Pushes are serialized, but event workers only wait for the
+            # config lock while the table is merged and copied, never on I/O
+            with self._push_lock:
+                for attempt in range(self.push_conflict_retries + 1):
+                    remote = self.get_tunnel_config(cache=False)
+                    config, pushed = self._prepare_push(remote)
+                    try:
+                        result = self._api(
+                            'zero_trust.tunnels.configurations.update', self.cf.zero_trust.tunnels.configurations.update,
+                            account_id=self.account_id,
+                            tunnel_id=self.tunnel_id,
+                            config=config
+                        )
+                    except ConflictError:
+                        if attempt == self.push_conflict_retries:
+                            raise
+                        self._count_push_conflict(attempt)
+                        time.sleep(random.uniform(0.1, 0.5))
+                        continue
+                    self._finish_push(remote, result, pushed)
+                    break
+
             logger.info("Successfully pushed tunnel configuration")
+            TUNNEL_PUSHES.inc(outcome='success')
+            self.save_snapshot()
 
         except Exception as e:
+            TUNNEL_PUSHES.inc(outcome='error')
             logger.error(f"Error pushing tunnel configuration: {str(e)}")
             raise
 
-    def update_dns_record(self, labels: dict, action: str = 'start'):
-        """Update a single DNS record based on container labels."""
+    def refresh_dns_record(self, subdomain: str, lane: int = LANE_NORMAL):
+        """Re-read a single DNS record from Cloudflare into the local index."""
+        name = f"{subdomain}.{self.domain}"
+        records = self._iter_dns_records(lane=lane, zone_id=self.zone_id, type='CNAME', name={'exact': name})
+        return self._index_refreshed_record(subdomain, next((r for r in records if r.name == name), None))
+
+    @tracing.traced('dns update')
+    def update_dns_record(self, labels: ContainerLabels, action: str = 'start'):
+        """Update the DNS records of the subdomains of a container.
+
+        The local DNS record index is treated as authoritative, so unchanged
+        records cost no API calls. Single records are re-read from Cloudflare
+        only when a write reports a missing record or a conflict. Returns True
+        if a record was created, edited or deleted.
+        """
+        subdomain = ','.join(labels.subdomains)
         try:
 
-            enabled = labels.get('enabled', False)
-            if not enabled:
+            if not labels.enabled:
                 logger.debug("Cannot update DNS record: not enabled in labels")
                 return False
 
-            subdomain = labels.get('subdomain')
-            # Prepare record data using labels
-            record_data = {
-                'comment': 'managed via cloudflared-tunnel-manager',
-                'content': f'{self.tunnel_id}.cfargotunnel.com',
-                'name': f"{subdomain}.{self.domain}",
-                'proxied': labels.get('proxied', 'true').lower() == 'true',
-                'ttl': int(labels.get('ttl', 1)),
-                'type': 'CNAME'
-            }
-
-            # Get current state from Cloudflare
-            current_record = self.get_dns_records(search=subdomain)
-            in_cloudflare = current_record is not None
-            in_cache = subdomain in self.dns_record_cache
-
-            if not labels.get('enabled', True) or action == 'die':
-                # Handle disabled state - delete if exists
-                if in_cache or in_cloudflare:
-                    logger.info(f"Deleting DNS record for {subdomain}.{self.domain}")
-                    if in_cloudflare:
-                        self.cf.dns.records.delete(
-                            zone_id=self.zone_id,
-                            dns_record_id=current_record.id
-                        )
-                    if in_cache:
-                        del self.dns_record_cache[subdomain]
-                return True
+            if self.dns_record_cache.is_stale():
+                self.get_dns_records()
 
-            # Handle enabled state for DNS
-            if in_cloudflare:
-                if not in_cache:
-                    # Record exists in Cloudflare but not in cache
-                    logger.info(f"Adding existing DNS record for {subdomain}.{self.domain} to cache")
-                    self.dns_record_cache[subdomain] = current_record
-                
-                # Check if update needed based on modified timestamp
-                cached_record = self.dns_record_cache[subdomain]
-                if current_record.modified_on != cached_record.modified_on:
-                    logger.info(f"Updating DNS record for {subdomain}.{self.domain}")
-                    updated = self.cf.dns.records.edit(
-                        zone_id=self.zone_id,
-                        dns_record_id=current_record.id,
-                        **record_data
-                    )
-                    self.dns_record_cache[subdomain] = updated
-            else:
-                logger.info(f"Creating new DNS record for {subdomain}.{self.domain}")
-                new_record = self.cf.dns.records.create(
-                    zone_id=self.zone_id,
-                    **record_data
-                )
-                self.dns_record_cache[subdomain] = new_record
-
-            return True
+            changes = self.plan_dns_changes(labels, action)
+            tracing.current_span().set_attribute('change', ','.join(change.action for change in changes) or None)
+            for change in changes:
+                self.apply_dns_change(change)
+            return bool(changes)
 
         except Exception as e:
-            logger.error(f"Error updating DNS record for {subdomain}: {str(e)}")
+            logger.error("Error updating DNS record for %s: %s", subdomain, e, extra={'subdomain': subdomain})
             raise
 
-    def handle_container_update(self, labels: dict, action: str = 'start'):
-        """Handle both DNS and tunnel configuration updates for a container."""
+    @tracing.traced('dns apply')
+    def apply_dns_change(self, change: DnsChange, lane: int = None) -> None:
+        """Write a planned DNS change to Cloudflare and update the index.
+
+        Unless a priority `lane` is given, deletes go ahead of other writes.
+        """
+        lane = self._start_dns_change(change, lane)
+        operation, call, kwargs = self._dns_call(change)
+        try:
+            record = self._api(operation, call, lane=lane, **kwargs)
+        except NotFoundError:
+            if change.action == 'create':
+                raise
+            change, record = self._missing_record_change(change), None
+            if change.action == 'create':
+                operation, call, kwargs = self._dns_call(change)
+                record = self._api(operation, call, lane=lane, **kwargs)
+        except (BadRequestError, ConflictError):
+            if change.action != 'create':
+                raise
+            # Record exists in Cloudflare but not in the index, or a
+            # retried create had already gone through
+            current_record = self.refresh_dns_record(change.subdomain, lane=lane)
+            if current_record is None:
+                raise
+            change = self._existing_record_change(change, current_record)
+            if change is None:
+                return
+            operation, call, kwargs = self._dns_call(change)
+            record = self._api(operation, call, lane=lane, **kwargs)
+        self._finish_dns_change(change, record)
+
+    def handle_container_update(self, labels: ContainerLabels, action: str = 'start', event_time: int = None):
+        """Handle both DNS and tunnel configuration updates for a container.
+
+        Returns True if the update waits for a coalesced tunnel push, which
+        then observes the apply latency of the event at `event_time`.
+        """
         try:
-            subdomain = labels.get('subdomain')
-            if not labels.get('enabled', False):
-                logger.debug(f"Skipping update for disabled container")
+            subdomain = ','.join(labels.subdomains)
+            if not labels.enabled:
+                logger.debug("Skipping update for disabled container")
                 return False
 
             # First update DNS record and tunnel config
             has_dns_update = self.update_dns_record(labels, action)
             has_tunnel_update = self.update_tunnel_config(labels, action)
             
-            # Push tunnel config if there were any updates
+            # Schedule a coalesced tunnel config push if there were any updates
             if has_dns_update or has_tunnel_update:
-                self.push_tunnel_config()
+                self.push_scheduler.mark_dirty(f"{action} {subdomain}", event_time=event_time, action=action)
+                tracing.current_span().set_attribute('tunnel_push', 'scheduled')
+                return True
+            return False
 
         except Exception as e:
-            logger.error(f"Error handling container update for container '{subdomain}': {str(e)}")
+            logger.error(
+                "Error handling container update for container '%s': %s", subdomain, e,
+                extra={'subdomain': subdomain, 'action': action}
+            )
             raise
+
+    def flush_tunnel_config(self) -> bool:
+        """Push any pending tunnel configuration changes immediately."""
+        return self.push_scheduler.flush()
+
+    def close(self, save: bool = True) -> None:
+        """Stop the push scheduler, pushing any pending changes first, and save state.
+
+        With `save` False, as for a read-only plan, nothing is pushed or saved.
+        """
+        try:
+            self.push_scheduler.stop(flush=save)
+        except Exception as e:
+            logger.error(f"Error flushing pending tunnel configuration: {str(e)}")
+        if save:
+            self.save_snapshot()
@@ -0,0 +1,67 @@
+import threading
+
+class ContainerInfo:
+    """Parsed Cloudflare labels of a single container."""
+
+    __slots__ = ('id', 'name', 'labels')
+
+    def __init__(self, id: str, name: str, labels):
+        self.id = id
+        self.name = name
+        self.labels = labels
+
+class ContainerCache:
+    """Parsed Cloudflare labels and port of known containers, keyed by container ID.
+
+    Labels and port mappings are fixed when a container is created, so an
+    entry stays valid for the lifetime of the container ID.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._containers = {}
+        self._lock = threading.Lock()
+
+    def get(self, container_id: str):
+        """Return the cached ContainerInfo for a container, or None."""
+        with self._lock:
+            info = self._containers.get(container_id)
+            if info is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return info
+
+    def put(self, container_id: str, name: str, labels) -> ContainerInfo:
+        info = ContainerInfo(container_id, name, labels)
+        with self._lock:
+            self._containers[container_id] = info
+        return info
+
+    def pop(self, container_id: str):
+        """Remove and return the cached ContainerInfo for a container, or None."""
+        with self._lock:
+            info = self._containers.pop(container_id, None)
+            if info is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return info
+
+    def retain(self, container_ids) -> None:
+        """Drop entries for containers that are no longer running."""
+        keep = set(container_ids)
+        with self._lock:
+            for container_id in [c for c in self._containers if c not in keep]:
+                del self._containers[container_id]
+
+    def values(self) -> list:
+        with self._lock:
+            return list(self._containers.values())
+
+    def __contains__(self, container_id: str) -> bool:
+        return container_id in self._containers
+
+    def __len__(self) -> int:
+        return len(self._containers)
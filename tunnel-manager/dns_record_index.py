@@ -0,0 +1,129 @@
+import threading
+import time
+
+# Record fields the manager controls; any difference triggers an edit
+MANAGED_FIELDS = ('content', 'proxied', 'ttl', 'comment')
+
+def record_diff(current, desired: dict) -> dict:
+    """Return the managed fields of `desired` that differ from `current`."""
+    return {
+        field: desired[field]
+        for field in MANAGED_FIELDS
+        if field in desired and getattr(current, field, None) != desired[field]
+    }
+
+class DnsRecordSummary:
+    """Compact copy of the DNS record fields the manager uses."""
+
+    __slots__ = ('id', 'name', 'content', 'proxied', 'ttl', 'comment', 'modified_on')
+
+    def __init__(self, id, name, content=None, proxied=None, ttl=None, comment=None, modified_on=None):
+        self.id = id
+        self.name = name
+        self.content = content
+        self.proxied = proxied
+        self.ttl = ttl
+        self.comment = comment
+        self.modified_on = modified_on
+
+    @classmethod
+    def from_record(cls, record) -> 'DnsRecordSummary':
+        """Build a summary from an SDK record or another summary."""
+        modified_on = getattr(record, 'modified_on', None)
+        if hasattr(modified_on, 'isoformat'):
+            modified_on = modified_on.isoformat()
+        return cls(
+            id=record.id,
+            name=record.name,
+            content=getattr(record, 'content', None),
+            proxied=getattr(record, 'proxied', None),
+            ttl=getattr(record, 'ttl', None),
+            comment=getattr(record, 'comment', None),
+            modified_on=modified_on
+        )
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'DnsRecordSummary':
+        return cls(**{field: data.get(field) for field in cls.__slots__})
+
+    def to_dict(self) -> dict:
+        return {field: getattr(self, field) for field in self.__slots__}
+
+    def __eq__(self, other):
+        return isinstance(other, DnsRecordSummary) and self.to_dict() == other.to_dict()
+
+    def __repr__(self):
+        return f"DnsRecordSummary({self.name!r}, id={self.id!r})"
+
+def summarize(record) -> DnsRecordSummary:
+    """Return `record` as a DnsRecordSummary, converting SDK records."""
+    return record if isinstance(record, DnsRecordSummary) else DnsRecordSummary.from_record(record)
+
+class DnsRecordIndex:
+    """Local index of DNS records keyed by subdomain.
+
+    The index is treated as the source of truth between refreshes: lookups
+    never hit the Cloudflare API. Records are kept as DnsRecordSummary
+    objects rather than full SDK models, so large zones stay small in
+    memory. It is considered stale once `refresh_interval` seconds have
+    passed since the last full refresh, or after `mark_stale` is called.
+    """
+
+    def __init__(self, refresh_interval: float = 3600):
+        self.refresh_interval = refresh_interval
+        self.refreshed_at = None
+        self.hits = 0
+        self.misses = 0
+        self._records = {}
+        self._lock = threading.RLock()
+
+    def replace(self, records: dict, age: float = 0) -> None:
+        """Replace the whole index after a full listing.
+
+        `age` is how many seconds old the records already are, e.g. when they
+        were restored from a state snapshot rather than freshly listed.
+        """
+        with self._lock:
+            self._records = {subdomain: summarize(record) for subdomain, record in records.items()}
+            self.refreshed_at = time.monotonic() - age
+
+    def is_stale(self) -> bool:
+        """Return True if the index needs a full refresh."""
+        if self.refreshed_at is None:
+            return True
+        if not self.refresh_interval or self.refresh_interval <= 0:
+            return False
+        return time.monotonic() - self.refreshed_at >= self.refresh_interval
+
+    def mark_stale(self) -> None:
+        """Force a full refresh on next access."""
+        self.refreshed_at = None
+
+    def get(self, subdomain: str):
+        """Return the cached record for a subdomain, or None."""
+        with self._lock:
+            record = self._records.get(subdomain)
+            if record is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return record
+
+    def put(self, subdomain: str, record) -> None:
+        with self._lock:
+            self._records[subdomain] = summarize(record)
+
+    def remove(self, subdomain: str):
+        """Remove and return the record for a subdomain, or None."""
+        with self._lock:
+            return self._records.pop(subdomain, None)
+
+    def items(self) -> list:
+        with self._lock:
+            return list(self._records.items())
+
+    def __contains__(self, subdomain: str) -> bool:
+        return subdomain in self._records
+
+    def __len__(self) -> int:
+        return len(self._records)
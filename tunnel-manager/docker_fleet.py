@@ -0,0 +1,127 @@
+import logging
+import threading
+from typing import Callable
+
+from label_schema import ContainerLabels
+
+logger = logging.getLogger('dns-manager')
+
+class DockerFleet:
+    """Watch several Docker hosts and apply their events through one queue.
+
+    Each host has its own DockerManager with its own connection, container
+    cache and event stream position, but all of them feed a shared event
+    queue drained by one pool of workers. Changes from every host therefore
+    end up in the same ingress table and coalesced pushes, instead of each
+    host overwriting the tunnel configuration of the others.
+
+    Hosts are expected to have synchronized clocks, as event positions after
+    a reconcile are taken from the local clock.
+    """
+
+    def __init__(self, managers: list):
+        if not managers:
+            raise ValueError("At least one Docker host is required")
+        names = [manager.name for manager in managers]
+        if len(set(names)) != len(names):
+            raise ValueError(f"Docker host names must be unique: {', '.join(names)}")
+        self.managers = list(managers)
+        self.event_queue = self.managers[0].event_queue
+        self._gap_lock = threading.Lock()
+        self._watchers = []
+
+    def running_container_labels(self) -> list:
+        """Return the labels of the running containers of all hosts.
+
+        Raises if any host cannot be listed, so that a reconcile never prunes
+        the containers of an unreachable host.
+        """
+        labels = []
+        for manager in self.managers:
+            containers = manager.get_running_containers()
+            logger.info(f"Found {len(containers)} running containers on {manager.name}")
+            labels.extend(manager.get_container_labels(container) for container in containers)
+        return labels
+
+    def resume_from(self, time_nano: int) -> None:
+        for manager in self.managers:
+            manager.resume_from(time_nano)
+
+    def served_subdomains(self, labels: ContainerLabels) -> set:
+        """Return the subdomains of a container that a running container on any host also serves."""
+        subdomains = set(labels.subdomains)
+        served = set()
+        for manager in self.managers:
+            for info in manager.container_cache.values():
+                other = info.labels
+                if other and (other.zone, other.tunnel) == (labels.zone, labels.tunnel):
+                    # Containers with rejected labels keep the routes they ask for
+                    served.update(subdomains.intersection(other.subdomains + other.reserved))
+        return served
+
+    def start_watching(self, on_gap: Callable = None) -> None:
+        """Start reading the events of all hosts into the shared queue on background threads.
+
+        Events are buffered (and collapsed) in the queue until `start_workers`
+        is called, so watching can begin before the Cloudflare state is loaded.
+        """
+        def handle_gap():
+            # Gaps on several hosts at once need only one reconcile at a time
+            with self._gap_lock:
+                on_gap()
+
+        for manager in self.managers:
+            thread = threading.Thread(
+                target=manager.watch_events,
+                args=(None, handle_gap if on_gap else None, False),
+                name=f'docker-events-{manager.name}',
+                daemon=True
+            )
+            thread.start()
+            self._watchers.append(thread)
+
+    def start_workers(self, callback: Callable) -> None:
+        """Start applying queued events through the callback."""
+        def apply(labels: ContainerLabels, action: str = 'start', event_time: int = None):
+            # A container that moved to another host (or was recreated) must
+            # not lose its routes when the old container stops afterwards
+            if action == 'die':
+                served = self.served_subdomains(labels)
+                if served:
+                    logger.info(f"Keeping {', '.join(sorted(served))}, served by another running container")
+                    labels = labels.without(served)
+                    if not labels.routes:
+                        return False
+            return callback(labels, action, event_time=event_time)
+
+        self.managers[0].start_workers(apply)
+
+    def wait(self) -> None:
+        """Block until all event watchers have stopped."""
+        for thread in self._watchers:
+            thread.join()
+
+    def watch_events(self, callback: Callable, on_gap: Callable = None):
+        """Watch the events of all hosts; blocks like DockerManager.watch_events."""
+        self.start_watching(on_gap)
+        self.start_workers(callback)
+        self.wait()
+
+    def stop(self) -> None:
+        """Stop the event watchers and workers."""
+        for manager in self.managers:
+            manager.stop()
+
+    @property
+    def cache_hits(self) -> int:
+        return sum(manager.container_cache.hits for manager in self.managers)
+
+    @property
+    def cache_misses(self) -> int:
+        return sum(manager.container_cache.misses for manager in self.managers)
+
+    def __iter__(self):
+        return iter(self.managers)
+
+    def __len__(self) -> int:
+        return len(self.managers)
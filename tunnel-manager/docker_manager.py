@@ -2,17 +2,84 @@ from typing import Callable
 import docker
 import logging
 import json
+import random
+import threading
+import time
+from collections import deque
+from container_cache import ContainerCache
+from event_queue import EventQueue
+from label_schema import ContainerLabels, LabelError, parse_labels, rejected_labels
+from metrics import DOCKER_RECONNECTS, EVENT_APPLY_LATENCY, INVALID_LABELS
+import tracing
 
 logger = logging.getLogger('dns-manager')
 
+# Number of events the Docker daemon keeps in memory for replay
+DOCKER_EVENT_BUFFER = 256
+
+def _docker_time(time_nano: int) -> str:
+    """Format a nanosecond timestamp for the since/until parameters of the events API."""
+    return f"{time_nano // 10**9}.{time_nano % 10**9:09d}"
+
+def replaces_pending(pending: tuple, item: tuple) -> bool:
+    """Return True if `item` may replace the pending item: both are events of one container.
+
+    Containers sharing a subdomain share a queue key, e.g. when a service is
+    recreated or moves between hosts. Each of their events must be applied,
+    in order, so that the container cache knows which of them still serve
+    the subdomain.
+    """
+    _, pending_event = pending
+    _, event = item
+    return pending_event.get('id') == event.get('id')
+
 class DockerManager:
-    def __init__(self):
-        self.client = docker.DockerClient(base_url='unix://var/run/docker.sock')
-        logger.info("Successfully initialized Docker client")
+    def __init__(self, snapshot=None, reconnect_min_delay=1.0, reconnect_max_delay=60.0,
+                 event_retention=900, event_workers=4, event_queue_size=1000, client=None,
+                 name: str = 'local', base_url: str = 'unix://var/run/docker.sock', host_ip: str = None,
+                 event_queue: EventQueue = None):
+        self.name = name
+        # Address of this host in ingress service URLs; None uses the manager's HOST_IP
+        self.host_ip = host_ip
+        self.client = client or docker.DockerClient(
+            base_url=base_url,
+            # Use the ssh binary, so ssh:// hosts need no extra Python packages
+            use_ssh_client=base_url.startswith('ssh://')
+        )
+        # State snapshot that records the last processed event time per host
+        self.snapshot = snapshot
+        self.reconnect_min_delay = reconnect_min_delay
+        self.reconnect_max_delay = reconnect_max_delay
+        # Longest gap (seconds) the daemon is trusted to be able to replay
+        self.event_retention = event_retention
+        self.reconnects = 0
+        self.last_event_time = snapshot.event_time(name) if snapshot else None
+        self._last_event_keys = set()
+        # Queued events not yet applied as [time_nano, applied], in the order
+        # read; the snapshot resumes from the oldest of them
+        self._unapplied = deque()
+        self._unapplied_by_container = {}
+        self._position_lock = threading.Lock()
+
+        # Parsed labels of known containers, so most events need no inspect call
+        self.container_cache = ContainerCache()
+
+        # Events are decoded by the watcher and applied by worker threads; the
+        # queue may be shared with the managers of other Docker hosts
+        self.event_queue = event_queue or EventQueue(maxsize=event_queue_size)
+        self.event_workers = max(1, event_workers)
+        self._workers = []
+        self._events = None
+        self._stopped = False
+        logger.info(f"Successfully initialized Docker client for {name}")
+
+    def get_container_labels(self, container_or_event) -> ContainerLabels:
+        """Parse the Cloudflare labels of a container or event.
+
+        Labels of containers are parsed once and cached by container ID.
+        Invalid labels are logged and the container is treated as disabled,
+        so its events cost no further work and its existing routes are kept.
 
-    def get_container_labels(self, container_or_event) -> dict:
-        """Extract Cloudflare-related labels from container or event data.
-        
         Args:
             container_or_event: Either a docker.models.containers.Container object
                               or a dictionary containing event data
@@ -23,100 +90,329 @@ class DockerManager:
                 if 'Actor' not in container_or_event:
                     logger.error("Invalid event data: missing Actor field")
                     return None
-                    
+
                 labels = container_or_event['Actor'].get('Attributes', {})
                 container_name = labels.get('name', 'unknown')
+                # Events carry no port mappings
+                host_port = None
             else:
-                # Handle container object
+                # Handle container object, reusing labels parsed earlier
+                info = self.container_cache.get(container_or_event.id)
+                if info is not None:
+                    return info.labels
                 labels = container_or_event.labels
                 container_name = container_or_event.name
+                mappings = [mapping for mapping in container_or_event.ports.values() if mapping]
+                host_port = mappings[-1][0].get('HostPort') if mappings else None
 
-            # Get all labels prefixed with cloudflare
-            cloudflare_labels = {
-                key.replace('cloudflare.', ''): value
-                for key, value in labels.items()
-                if key.startswith('cloudflare.')
-            }
-
-            # Set enabled state based on cloudflare.enabled label to boolean
-            cloudflare_labels['enabled'] = labels.get('cloudflare.enabled', '').lower() == 'true'
-            
-            # Ensure other required labels exist for enabled containers
-            if cloudflare_labels['enabled']:
-                if not cloudflare_labels.get('subdomain'):
-                    cloudflare_labels['subdomain'] = container_name
-
-                # Get port from container labels or event data
-                if not cloudflare_labels.get('port'):
-                    if isinstance(container_or_event, dict):
-                        # For events, we can't get port info, use default
-                        cloudflare_labels['port'] = '80'
-                    elif any(container_or_event.ports.values()):
-                        cloudflare_labels['port'] = list(container_or_event.ports.values())[-1][0].get('HostPort')
-
-            logger.debug(f"Found Cloudflare labels for container {container_name}: {cloudflare_labels}")
-            return cloudflare_labels
+            try:
+                parsed = parse_labels(labels, container_name, host_port=host_port, host_ip=self.host_ip)
+            except LabelError as e:
+                INVALID_LABELS.inc()
+                logger.warning(
+                    "Ignoring container %s, its Cloudflare labels are invalid: %s", container_name, e,
+                    extra={'container': container_name}
+                )
+                parsed = rejected_labels(labels, container_name, str(e))
+            for warning in parsed.warnings:
+                logger.warning("Container %s: %s", container_name, warning, extra={'container': container_name})
+
+            logger.debug("Found Cloudflare labels for container %s: %s", container_name, parsed)
+            if not isinstance(container_or_event, dict):
+                self.container_cache.put(container_or_event.id, container_name, parsed)
+            return parsed
 
         except Exception as e:
             logger.error(f"Error getting labels for container: {str(e)}")
             return None
 
     def get_running_containers(self):
-        """Get list of all running containers."""
+        """Get list of all running containers and refresh the container cache."""
         try:
-            return self.client.containers.list()
+            containers = self.client.containers.list()
+            self.container_cache.retain(container.id for container in containers)
+            for container in containers:
+                self.get_container_labels(container)
+            return containers
         except Exception as e:
             logger.error(f"Error getting running containers: {str(e)}")
             raise
 
+    @tracing.traced('docker inspect')
     def get_container_by_id(self, container_id: str) -> docker.models.containers.Container:
         """Get container by ID."""
         try:
             return self.client.containers.get(container_id)
         except docker.errors.NotFound:
-            logger.warning(f"Container {container_id} not found")
+            logger.warning("Container %s not found", container_id)
             return None
         except Exception as e:
             logger.error(f"Error getting container {container_id}: {str(e)}")
             raise
 
+    @tracing.traced('container event')
     def handle_container_event(self, event: dict, callback: Callable):
         """Handle Docker container events."""
+        span = tracing.current_span()
         try:
             action = event['Action']
-            
-            # For 'die' events, use the event data directly
+            container_id = event.get('id')
+            attributes = event.get('Actor', {}).get('Attributes', {})
+            container_name = attributes.get('name', 'unknown')
+            span.set_attribute('action', action)
+            span.set_attribute('container', container_name)
+            span.set_attribute('docker_host', self.name)
+            if event.get('timeNano'):
+                span.set_attribute('event_age_seconds', round((time.time_ns() - event['timeNano']) / 1e9, 3))
+
             if action == 'die':
-                labels = self.get_container_labels(event)
-                container_name = event.get('Actor', {}).get('Attributes', {}).get('name', 'unknown')
+                # Use the labels the container was registered with, falling
+                # back to the event data for containers started before us
+                info = self.container_cache.pop(container_id)
+                labels = info.labels if info else self.get_container_labels(event)
             else:
-                # For other events (like 'start'), try to get the container
-                container = self.get_container_by_id(event['id'])
-                if not container:
-                    return
-                container_name = container.name
-                labels = self.get_container_labels(container)
+                info = self.container_cache.get(container_id)
+                if info:
+                    labels = info.labels
+                else:
+                    # Event attributes carry the container labels; only the
+                    # port mapping requires inspecting the container
+                    labels = self.get_container_labels(event)
+                    if labels and labels.enabled and not labels.explicit_ports:
+                        container = self.get_container_by_id(container_id)
+                        if not container:
+                            return
+                        labels = self.get_container_labels(container)
+                    elif labels is not None:
+                        self.container_cache.put(container_id, container_name, labels)
 
             if not labels:
                 return
+            span.set_attribute('subdomain', ','.join(labels.subdomains))
 
-            logger.info(f"Processing {action} event for container: {container_name}")
-            logger.debug(f"Event details: {json.dumps(event)}")
+            logger.info(
+                "Processing %s event for container: %s", action, container_name,
+                extra={'container': container_name, 'action': action, 'docker_host': self.name}
+            )
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Event details: %s", json.dumps(event))
 
-            if labels.get('enabled', False):
-                callback(labels, action)
+            if labels.enabled:
+                # Changes waiting for a coalesced push are measured once it is sent
+                pending = callback(labels, action, event_time=event.get('timeNano'))
+                if event.get('timeNano') and not pending:
+                    EVENT_APPLY_LATENCY.observe(
+                        max(0.0, (time.time_ns() - event['timeNano']) / 1e9), action=action
+                    )
             else:
-                logger.debug(f"Container {container_name} has no valid Cloudflare labels")
+                logger.debug("Container %s has no valid Cloudflare labels", container_name)
                     
         except Exception as e:
-            logger.error(f"Error handling container event: {str(e)}")
+            span.set_error(e)
+            logger.error("Error handling container event: %s", e)
+
+    def resume_from(self, time_nano: int) -> None:
+        """Skip events older than `time_nano`, e.g. after a full reconcile."""
+        with self._position_lock:
+            if not self.last_event_time or time_nano > self.last_event_time:
+                self.last_event_time = time_nano
+                self._last_event_keys = set()
+            # Queued events before it are covered by the reconcile
+            while self._unapplied and self._unapplied[0][0] < time_nano:
+                self._unapplied.popleft()[1] = True
+            self._save_position()
+
+    def _is_duplicate(self, event: dict) -> bool:
+        """Return True for events already processed before a reconnect."""
+        time_nano = event.get('timeNano')
+        if not time_nano or not self.last_event_time:
+            return False
+        if time_nano < self.last_event_time:
+            return True
+        return time_nano == self.last_event_time and (event.get('id'), event.get('Action')) in self._last_event_keys
+
+    def _mark_processed(self, event: dict) -> None:
+        """Advance the read position, where the stream resumes after a reconnect."""
+        time_nano = event.get('timeNano')
+        if not time_nano:
+            return
+        with self._position_lock:
+            if time_nano != self.last_event_time:
+                self.last_event_time = time_nano
+                self._last_event_keys = set()
+            self._last_event_keys.add((event.get('id'), event.get('Action')))
+            self._save_position()
+
+    def _mark_queued(self, event: dict) -> None:
+        time_nano = event.get('timeNano')
+        if not time_nano:
+            return
+        entry = [time_nano, False]
+        with self._position_lock:
+            self._unapplied.append(entry)
+            self._unapplied_by_container.setdefault(event.get('id'), deque()).append(entry)
+
+    def _mark_applied(self, event: dict) -> None:
+        """Mark an event applied, with the earlier events of its container it replaced in the queue."""
+        time_nano = event.get('timeNano')
+        if not time_nano:
+            return
+        with self._position_lock:
+            entries = self._unapplied_by_container.get(event.get('id'))
+            while entries and entries[0][0] <= time_nano:
+                entries.popleft()[1] = True
+            if not entries:
+                self._unapplied_by_container.pop(event.get('id'), None)
+            self._save_position()
+
+    def _save_position(self) -> None:
+        # Called with the position lock held. After a restart, events are
+        # replayed from the oldest one that was read but not yet applied.
+        while self._unapplied and self._unapplied[0][1]:
+            self._unapplied.popleft()
+        time_nano = self._unapplied[0][0] if self._unapplied else self.last_event_time
+        if self.snapshot is not None and time_nano:
+            self.snapshot.set_event_time(self.name, time_nano)
+
+    def event_key(self, event: dict) -> str:
+        """Key used to collapse queued events: the hostname when known, else the container ID."""
+        attributes = event.get('Actor', {}).get('Attributes', {})
+        if attributes.get('cloudflare.enabled', '').lower() == 'true':
+            subdomain = attributes.get('cloudflare.subdomain') or attributes.get('name', event.get('id'))
+            # The same subdomain can exist in several tunnel/zone shards
+            return (
+                f"subdomain:{attributes.get('cloudflare.tunnel', '')}:"
+                f"{attributes.get('cloudflare.zone', '')}:{subdomain}"
+            )
+        return 'container:' + str(event.get('id'))
 
-    def watch_events(self, callback: Callable):
-        """Watch for container events and call callback when they occur."""
+    def start_workers(self, callback: Callable) -> None:
+        """Start worker threads that apply queued events through the callback."""
+        self._workers = [w for w in self._workers if w.is_alive()]
+        for i in range(len(self._workers), self.event_workers):
+            worker = threading.Thread(
+                target=self._work, args=(callback,), name=f'event-worker-{i}', daemon=True
+            )
+            worker.start()
+            self._workers.append(worker)
+
+    def _work(self, callback: Callable) -> None:
+        while True:
+            entry = self.event_queue.get()
+            if entry is None:
+                return
+            # Items carry the manager of the host the event came from
+            key, (manager, event) = entry
+            try:
+                manager.handle_container_event(event, callback)
+            finally:
+                manager._mark_applied(event)
+                self.event_queue.task_done(key)
+
+    def stop(self) -> None:
+        """Stop watching events and stop the event workers."""
+        self._stopped = True
+        events = self._events
+        if events is not None and hasattr(events, 'close'):
+            # Unblocks the watcher waiting for the next event
+            events.close()
+        self.event_queue.close()
+
+    def watch_events(self, callback: Callable, on_gap: Callable = None, start_workers: bool = True):
+        """Watch for container events and queue them for the worker threads.
+
+        Reading the event stream never waits on the callback: events are only
+        decoded and queued here, and `event_workers` threads apply them.
+
+        When the event stream breaks, reconnects with exponential backoff and
+        resumes from the last processed event so that events fired during the
+        gap are replayed by the daemon. If the gap may exceed what the daemon
+        retains, `on_gap` is called to reconcile the current state instead.
+
+        With `start_workers` False, the workers of a shared event queue are
+        expected to be started by another manager, and queued events wait
+        until they are. Returns once `stop` is called.
+        """
+        if start_workers:
+            self.start_workers(callback)
+        delay = self.reconnect_min_delay
+        while not self._stopped:
+            since = self.last_event_time
+            connected_at = time.time_ns()
+            replayed = 0
+            try:
+                if since:
+                    gap = (connected_at - since) / 1e9
+                    logger.info(f"Resuming container events from {gap:.1f}s ago")
+                    reason = None
+                    if gap > self.event_retention:
+                        reason = f"Event gap of {gap:.0f}s exceeds retention"
+                    elif self._buffer_overflowed(since, connected_at):
+                        reason = "The daemon's event buffer overflowed during the gap"
+                    if reason:
+                        logger.warning(f"{reason}, reconciling containers")
+                        self._handle_gap(on_gap)
+                        self.resume_from(connected_at)
+                        since = connected_at
+
+                events = self._events = self.client.events(
+                    decode=True,
+                    filters={'Type': 'container'},
+                    since=_docker_time(since) if since else None
+                )
+                for event in events:
+                    delay = self.reconnect_min_delay
+                    if self._is_duplicate(event):
+                        continue
+
+                    if event.get('timeNano', connected_at) < connected_at:
+                        replayed += 1
+
+                    if event['Action'] in ['start', 'die']:
+                        self._mark_queued(event)
+                        self.event_queue.put(self.event_key(event), (self, event), replace=replaces_pending)
+                        depth = self.event_queue.depth()
+                        if depth and depth % 100 == 0:
+                            logger.warning("Container event queue depth is %d (lag %.1fs)", depth, self.event_queue.lag())
+                    self._mark_processed(event)
+
+                if not self._stopped:
+                    logger.warning(f"Container event stream of {self.name} ended")
+            except Exception as e:
+                if self._stopped:
+                    break
+                logger.error(f"Error watching container events on {self.name}: {str(e)}")
+
+            if self._stopped:
+                break
+            if replayed:
+                logger.info(f"Replayed {replayed} missed container events")
+            self.reconnects += 1
+            DOCKER_RECONNECTS.inc()
+            sleep_for = delay * random.uniform(0.5, 1.0)
+            logger.info(f"Reconnecting to Docker events on {self.name} in {sleep_for:.1f}s")
+            time.sleep(sleep_for)
+            delay = min(delay * 2, self.reconnect_max_delay)
+
+    def _buffer_overflowed(self, since: int, until: int) -> bool:
+        """Return True if the daemon may have dropped events fired between `since` and `until`.
+
+        The daemon keeps the last DOCKER_EVENT_BUFFER events of every type,
+        so they are counted without the container filter of the stream.
+        """
+        events = self.client.events(decode=True, since=_docker_time(since), until=_docker_time(until))
+        try:
+            for count, _ in enumerate(events, 1):
+                if count >= DOCKER_EVENT_BUFFER:
+                    return True
+            return False
+        finally:
+            events.close()
+
+    def _handle_gap(self, on_gap: Callable) -> None:
+        if not on_gap:
+            return
         try:
-            for event in self.client.events(decode=True, filters={'Type': 'container'}):
-                if event['Action'] in ['start', 'die']:
-                    self.handle_container_event(event, callback)
+            on_gap()
         except Exception as e:
-            logger.error(f"Error watching container events: {str(e)}")
-            raise
+            logger.error(f"Error reconciling after event gap: {str(e)}")
@@ -0,0 +1,141 @@
+import logging
+import threading
+from typing import Callable, Iterable
+
+from dns_record_index import DnsRecordSummary
+from metrics import DRIFT_CHECKS, DRIFT_REPAIRS
+from reconciler import apply_changes, desired_state, plan_changes
+import tracing
+
+logger = logging.getLogger('dns-manager')
+
+class DriftReconciler:
+    """Periodically detect and repair drift between Cloudflare and the local state.
+
+    Each check costs two API calls: one read of the tunnel configuration,
+    whose `version` shows whether anyone changed the ingress rules, and one
+    listing of the CNAME records owned by the manager, compared with the
+    index by id and `modified_on` to find records edited or deleted outside
+    the manager. Only the changed parts are taken over into the local state,
+    and the usual plan/apply then writes back only the subdomains that differ
+    from the running containers listed by `desired_labels`.
+    """
+
+    def __init__(self, cf_manager, desired_labels: Callable[[], Iterable], interval: float = 300,
+                 prune: bool = False, max_workers: int = 8):
+        self.cf_manager = cf_manager
+        self.desired_labels = desired_labels
+        self.interval = interval
+        self.prune = prune
+        self.max_workers = max_workers
+
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+        # Counters
+        self.checks = 0
+        self.drifts = 0
+
+    def start(self) -> None:
+        """Start checking every `interval` seconds on a background thread."""
+        if not self.interval or self.interval <= 0:
+            logger.info("Drift reconciliation is disabled")
+            return
+        with self._cond:
+            self._stopped = False
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='drift-reconciler', daemon=True)
+                self._thread.start()
+
+    def stop(self) -> None:
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._stopped, timeout=self.interval)
+                if self._stopped:
+                    return
+            try:
+                self.check()
+            except Exception as e:
+                DRIFT_CHECKS.inc(outcome='error')
+                logger.error(f"Drift check failed: {str(e)}")
+
+    def _sync_tunnel_config(self) -> bool:
+        """Merge the remote tunnel configuration into the local one if its version changed."""
+        return self.cf_manager.merge_tunnel_config(self.cf_manager.get_tunnel_config(cache=False))
+
+    def _sync_dns_records(self) -> int:
+        """Take records that were edited or deleted remotely into the index; return how many."""
+        cf = self.cf_manager
+        target = f'{cf.tunnel_id}.cfargotunnel.com'
+        suffix = f'.{cf.domain}'
+        remote = {
+            record.name[:-len(suffix)]: record
+            for record in cf.list_tunnel_dns_records()
+            if record.name.endswith(suffix)
+        }
+
+        # A copy, as lookups through get() would count as cache hits and misses
+        cached_records = dict(cf.dns_record_cache.items())
+        changed = 0
+        for subdomain, record in remote.items():
+            cached = cached_records.get(subdomain)
+            if cached is None or DnsRecordSummary.from_record(cached) != DnsRecordSummary.from_record(record):
+                logger.warning(f"DNS record for {record.name} changed outside the manager")
+                cf.dns_record_cache.put(subdomain, record)
+                changed += 1
+
+        for subdomain, cached in cf.dns_record_cache.items():
+            if subdomain not in remote and getattr(cached, 'content', None) == target:
+                # Deleted, re-pointed or unmarked; re-read just this record
+                logger.warning(f"DNS record for {subdomain}{suffix} is no longer owned by the manager")
+                cf.refresh_dns_record(subdomain)
+                changed += 1
+
+        return changed
+
+    @tracing.traced('drift check')
+    def check(self) -> dict:
+        """Run one drift check and repair; return a summary of what was found."""
+        cf = self.cf_manager
+        # Push pending local changes first so they are not mistaken for drift
+        cf.flush_tunnel_config()
+
+        config_changed = self._sync_tunnel_config()
+        dns_changed = self._sync_dns_records()
+
+        desired = desired_state(self.desired_labels())
+        changes = plan_changes(cf, desired, prune=self.prune)
+        report = {
+            'tunnel_config_changed': config_changed,
+            'dns_records_changed': dns_changed,
+            **changes.summary(),
+        }
+        self.checks += 1
+
+        if not changes:
+            DRIFT_CHECKS.inc(outcome='clean' if not (config_changed or dns_changed) else 'adopted')
+            logger.debug("Drift check found nothing to repair")
+            return report
+
+        self.drifts += 1
+        DRIFT_CHECKS.inc(outcome='repaired')
+        DRIFT_REPAIRS.inc(len(changes.dns_changes), kind='dns')
+        DRIFT_REPAIRS.inc(len(changes.ingress_upserts) + len(changes.ingress_removals), kind='ingress')
+        logger.info(
+            f"Repairing drift: {report['dns_creates']} DNS records to create, {report['dns_edits']} to edit, "
+            f"{report['dns_deletes']} to delete, {report['ingress_upserts']} ingress rules to set, "
+            f"{report['ingress_removals']} to remove"
+        )
+        errors = apply_changes(cf, changes, max_workers=self.max_workers)
+        cf.save_snapshot()
+        if errors:
+            raise errors[0]
+        return report
@@ -0,0 +1,124 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable
+
+class EventQueue:
+    """Bounded work queue that collapses pending items with the same key.
+
+    Putting an item whose key is already pending replaces the pending item in
+    place, so a rapid start -> die -> start for one container is processed
+    once, with the final event. An item the `replace` check refuses to
+    collapse is queued behind the pending one instead. A key is never handed
+    to two consumers at the same time: while an item is being processed,
+    newer items for the same key wait in the queue until `task_done` is
+    called.
+    """
+
+    def __init__(self, maxsize: int = 1000):
+        self.maxsize = maxsize
+        # key -> [[item, enqueued_at], ...] in arrival order
+        self._pending = OrderedDict()
+        self._size = 0
+        self._in_flight = set()
+        self._cond = threading.Condition()
+        self._closed = False
+
+        # Counters
+        self.enqueued = 0
+        self.collapsed = 0
+        self.processed = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    def put(self, key, item, timeout: float = None, replace: Callable = None) -> bool:
+        """Queue an item, replacing the last pending item with the same key.
+
+        `replace(pending, item)` may return False to keep the pending item and
+        queue the new one after it. Blocks while the queue is full. Returns
+        False if the queue was closed or the timeout expired.
+        """
+        with self._cond:
+            items = self._pending.get(key)
+            if items and (replace is None or replace(items[-1][0], item)):
+                items[-1][0] = item
+                self.collapsed += 1
+                return True
+
+            if not self._cond.wait_for(
+                lambda: self._closed or self._size < self.maxsize, timeout
+            ) or self._closed:
+                return False
+
+            self._pending.setdefault(key, []).append([item, time.monotonic()])
+            self._size += 1
+            self.enqueued += 1
+            self._cond.notify_all()
+            return True
+
+    def get(self, timeout: float = None):
+        """Return the oldest (key, item) whose key is not being processed.
+
+        Returns None if the queue was closed or the timeout expired.
+        """
+        with self._cond:
+            ready = lambda: self._closed or self._next_key() is not None
+            if not self._cond.wait_for(ready, timeout) or self._closed:
+                return None
+
+            key = self._next_key()
+            items = self._pending[key]
+            item, enqueued_at = items.pop(0)
+            if not items:
+                del self._pending[key]
+            self._size -= 1
+            self._in_flight.add(key)
+            self.last_lag = time.monotonic() - enqueued_at
+            self.max_lag = max(self.max_lag, self.last_lag)
+            self._cond.notify_all()
+            return key, item
+
+    def task_done(self, key) -> None:
+        """Mark the item for `key` as processed, releasing newer items for it."""
+        with self._cond:
+            self._in_flight.discard(key)
+            self.processed += 1
+            self._cond.notify_all()
+
+    def close(self) -> None:
+        """Wake up all producers and consumers and refuse further work."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def depth(self) -> int:
+        """Number of pending items."""
+        return self._size
+
+    def lag(self) -> float:
+        """Age in seconds of the oldest pending item."""
+        with self._cond:
+            if not self._pending:
+                return 0.0
+            _, enqueued_at = next(iter(self._pending.values()))[0]
+            return time.monotonic() - enqueued_at
+
+    def stats(self) -> dict:
+        """Return a snapshot of the queue counters."""
+        with self._cond:
+            return {
+                'depth': self._size,
+                'in_flight': len(self._in_flight),
+                'lag': self.lag(),
+                'enqueued': self.enqueued,
+                'collapsed': self.collapsed,
+                'processed': self.processed,
+                'last_lag': self.last_lag,
+                'max_lag': self.max_lag,
+            }
+
+    def _next_key(self):
+        for key in self._pending:
+            if key not in self._in_flight:
+                return key
+        return None
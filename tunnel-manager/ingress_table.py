@@ -0,0 +1,109 @@
+from typing import Callable, Iterable, Iterator, Optional
+
+class IngressTable:
+    """In-memory tunnel ingress rules keyed by (hostname, path).
+
+    Upserts and deletes are O(1) dictionary operations. Rules keep their
+    insertion order, except that path-specific rules are always emitted before
+    the path-less rule for the same hostname and catch-all rules (no hostname
+    and no path) are always emitted last, so the serialized list is valid for
+    cloudflared regardless of the order changes were applied in.
+    """
+
+    def __init__(self, rules: Iterable = ()):
+        self._rules = {}
+        self._catch_all = []
+        for rule in rules:
+            self.upsert(rule)
+
+    @staticmethod
+    def key(hostname: Optional[str], path: Optional[str] = None) -> tuple:
+        """Return the table key for a hostname and path."""
+        return (hostname or None, path or None)
+
+    @staticmethod
+    def is_catch_all(rule) -> bool:
+        """Return True if the rule matches every request."""
+        return not rule.hostname and not rule.path
+
+    def get(self, hostname: str, path: str = None):
+        """Return the rule for a hostname and path, or None."""
+        return self._rules.get(self.key(hostname, path))
+
+    def upsert(self, rule) -> bool:
+        """Insert or replace a rule. Returns True if the table changed."""
+        if self.is_catch_all(rule):
+            if rule in self._catch_all:
+                return False
+            self._catch_all.append(rule)
+            return True
+
+        key = self.key(rule.hostname, rule.path)
+        if self._rules.get(key) == rule:
+            return False
+        # Replacing an existing key keeps its position in the dict
+        self._rules[key] = rule
+        return True
+
+    def remove(self, hostname: str, path: str = None):
+        """Remove and return the rule for a hostname and path, or None."""
+        return self._rules.pop(self.key(hostname, path), None)
+
+    def keys(self) -> list:
+        """Return the (hostname, path) keys of all rules except catch-alls."""
+        return list(self._rules)
+
+    def copy(self) -> 'IngressTable':
+        table = IngressTable()
+        table._rules = dict(self._rules)
+        table._catch_all = list(self._catch_all)
+        return table
+
+    def __contains__(self, key) -> bool:
+        return self.key(*key) in self._rules
+
+    def __len__(self) -> int:
+        return len(self._rules) + len(self._catch_all)
+
+    def __iter__(self) -> Iterator:
+        return iter(self.to_list())
+
+    def to_list(self) -> list:
+        """Serialize the table into an ordered ingress list."""
+        # Group rules by the first position their hostname appeared at,
+        # placing path-specific rules ahead of the hostname's path-less rule.
+        host_order = {}
+        for hostname, _ in self._rules:
+            host_order.setdefault(hostname, len(host_order))
+
+        ordered = sorted(
+            enumerate(self._rules.items()),
+            key=lambda item: (host_order[item[1][0][0]], item[1][0][1] is None, item[0])
+        )
+        return [rule for _, (_, rule) in ordered] + list(self._catch_all)
+
+def three_way_merge(base: IngressTable, local: IngressTable, remote: IngressTable,
+                    owns: Callable[[str], bool]) -> tuple:
+    """Merge local ingress changes made since `base` into a newer `remote` table.
+
+    Rules the local side did not change since `base` are taken from
+    `remote`, as are catch-all rules. A rule changed on both sides keeps
+    the local version only if `owns(hostname)` is True; otherwise the remote
+    change wins. Returns the merged table and the keys that conflicted.
+    """
+    merged = remote.copy()
+    conflicts = []
+    for key in dict.fromkeys(base.keys() + local.keys()):
+        base_rule, local_rule = base.get(*key), local.get(*key)
+        if local_rule == base_rule:
+            continue
+        remote_rule = remote.get(*key)
+        if remote_rule not in (base_rule, local_rule):
+            conflicts.append(key)
+            if not owns(key[0]):
+                continue
+        if local_rule is None:
+            merged.remove(*key)
+        else:
+            merged.upsert(local_rule)
+    return merged, conflicts
@@ -0,0 +1,287 @@
+import re
+
+LABEL_PREFIX = 'cloudflare.'
+
+# Services cloudflared can reach; only http(s) origins can be routed by path
+SCHEMES = ('http', 'https', 'tcp', 'ssh', 'rdp')
+PATH_SCHEMES = ('http', 'https')
+
+# Origin request options (cloudflare.origin.<name>) and their types
+ORIGIN_OPTIONS = {
+    'ca_pool': str,
+    'connect_timeout': int,
+    'disable_chunked_encoding': bool,
+    'http2_origin': bool,
+    'http_host_header': str,
+    'keep_alive_connections': int,
+    'keep_alive_timeout': int,
+    'no_happy_eyeballs': bool,
+    'no_tls_verify': bool,
+    'origin_server_name': str,
+    'proxy_type': str,
+    'tcp_keep_alive': int,
+    'tls_timeout': int,
+}
+
+# Labels of a route, set once for the container or per cloudflare.routes.<name>
+ROUTE_LABELS = ('subdomain', 'path', 'port', 'scheme', 'host_ip')
+CONTAINER_LABELS = ('enabled', 'proxied', 'ttl', 'zone', 'tunnel')
+
+# Cloudflare accepts underscores in record names, e.g. compose v1 names like project_web_1
+_SUBDOMAIN = re.compile(r'^(\*|[a-z0-9_]([a-z0-9_-]{0,61}[a-z0-9_])?)(\.[a-z0-9_]([a-z0-9_-]{0,61}[a-z0-9_])?)*$')
+_ROUTE_NAME = re.compile(r'^[A-Za-z0-9_-]+$')
+
+class LabelError(ValueError):
+    """Raised for cloudflare.* labels that cannot be turned into routes."""
+
+def _parse_bool(name: str, value: str) -> bool:
+    lowered = value.strip().lower()
+    if lowered not in ('true', 'false'):
+        raise LabelError(f"cloudflare.{name} must be true or false, not {value!r}")
+    return lowered == 'true'
+
+def _parse_int(name: str, value: str, low: int = 0, high: int = None) -> int:
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        raise LabelError(f"cloudflare.{name} must be a number, not {value!r}")
+    if number < low or (high is not None and number > high):
+        raise LabelError(f"cloudflare.{name} must be between {low} and {high}, not {number}")
+    return number
+
+def _parse_subdomain(name: str, value: str) -> str:
+    subdomain = value.strip().lower()
+    if not _SUBDOMAIN.match(subdomain) or len(subdomain) > 253:
+        raise LabelError(f"cloudflare.{name} is not a valid DNS name: {value!r}")
+    return subdomain
+
+def _parse_path(name: str, value: str) -> str:
+    try:
+        re.compile(value)
+    except re.error as e:
+        raise LabelError(f"cloudflare.{name} is not a valid path expression: {str(e)}")
+    return value
+
+def _parse_origin(prefix: str, options: dict) -> dict:
+    parsed = {}
+    for option, value in options.items():
+        kind = ORIGIN_OPTIONS.get(option)
+        name = f"{prefix}origin.{option}"
+        if kind is None:
+            raise LabelError(f"Unknown label cloudflare.{name}")
+        if kind is bool:
+            parsed[option] = _parse_bool(name, value)
+        elif kind is int:
+            parsed[option] = _parse_int(name, value)
+        else:
+            parsed[option] = value
+    return parsed
+
+class Route:
+    """One ingress rule of a container: a subdomain, an optional path and the origin service."""
+
+    __slots__ = ('subdomain', 'path', 'scheme', 'host_ip', 'port', 'origin_request')
+
+    def __init__(self, subdomain: str, path: str = None, scheme: str = 'http', host_ip: str = None,
+                 port: int = 80, origin_request: dict = None):
+        self.subdomain = subdomain
+        self.path = path
+        self.scheme = scheme
+        self.host_ip = host_ip
+        self.port = port
+        self.origin_request = origin_request
+
+    def service(self, default_host_ip: str) -> str:
+        """Return the origin URL cloudflared forwards to."""
+        return f"{self.scheme}://{self.host_ip or default_host_ip}:{self.port}"
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, Route) and all(
+            getattr(self, field) == getattr(other, field) for field in self.__slots__
+        )
+
+    def __repr__(self) -> str:
+        path = self.path or ''
+        return f"Route({self.subdomain}{path} -> {self.scheme}://{self.host_ip or '*'}:{self.port})"
+
+class ContainerLabels:
+    """The validated cloudflare.* labels of a container.
+
+    Built once per container by `parse_labels`. `error` is set, and
+    `enabled` False, for containers whose labels were rejected, so they are
+    skipped without any further work; `reserved` then holds the subdomains
+    they ask for, whose existing records and rules must not be removed.
+    """
+
+    __slots__ = ('name', 'enabled', 'routes', 'proxied', 'ttl', 'zone', 'tunnel', 'explicit_ports', 'error',
+                 'reserved', 'warnings')
+
+    def __init__(self, name: str, enabled: bool = False, routes: tuple = (), proxied: bool = True, ttl: int = 1,
+                 zone: str = None, tunnel: str = None, explicit_ports: bool = True, error: str = None,
+                 reserved: tuple = (), warnings: tuple = ()):
+        self.name = name
+        self.enabled = enabled
+        self.routes = tuple(routes)
+        self.proxied = proxied
+        self.ttl = ttl
+        self.zone = zone
+        self.tunnel = tunnel
+        # False when a route's port is a default that inspecting the container may refine
+        self.explicit_ports = explicit_ports
+        self.error = error
+        # Subdomains asked for by rejected labels; their existing routes are left alone
+        self.reserved = tuple(reserved)
+        # Labels that were accepted but look wrong
+        self.warnings = tuple(warnings)
+
+    @property
+    def subdomains(self) -> tuple:
+        """The distinct subdomains of the routes, in label order."""
+        return tuple(dict.fromkeys(route.subdomain for route in self.routes))
+
+    def routes_for(self, subdomain: str) -> tuple:
+        return tuple(route for route in self.routes if route.subdomain == subdomain)
+
+    def without(self, subdomains) -> 'ContainerLabels':
+        """Return a copy without the routes of `subdomains`."""
+        skip = set(subdomains)
+        return ContainerLabels(
+            self.name, self.enabled, [route for route in self.routes if route.subdomain not in skip],
+            self.proxied, self.ttl, self.zone, self.tunnel, self.explicit_ports, self.error,
+            [subdomain for subdomain in self.reserved if subdomain not in skip], self.warnings
+        )
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, ContainerLabels) and all(
+            getattr(self, field) == getattr(other, field) for field in self.__slots__
+        )
+
+    def __repr__(self) -> str:
+        if not self.enabled:
+            return f"ContainerLabels({self.name!r}, disabled{': ' + self.error if self.error else ''})"
+        return f"ContainerLabels({self.name!r}, routes={list(self.routes)!r})"
+
+def parse_labels(labels: dict, name: str, host_port: str = None, host_ip: str = None) -> ContainerLabels:
+    """Parse and validate the cloudflare.* labels of a container.
+
+    A route is built for each subdomain in `cloudflare.subdomain` (comma
+    separated, the container name by default), and for each
+    `cloudflare.routes.<route>.subdomain`. Routes inherit the container's
+    port, scheme, host IP and `cloudflare.origin.*` options unless they set
+    their own. Ports default to `host_port`, the port the container
+    publishes, and then 80; `host_ip` is the IP of the Docker host.
+    Raises LabelError for malformed labels. Unknown labels, and values
+    the manager always accepted such as a proxied other than true, a
+    short ttl or a container name that is not a valid DNS name, are kept
+    as warnings instead.
+    """
+    values = {key[len(LABEL_PREFIX):]: value for key, value in labels.items() if key.startswith(LABEL_PREFIX)}
+    if values.pop('enabled', '').strip().lower() != 'true':
+        return ContainerLabels(name)
+
+    warnings = []
+    container, origin, named_routes = {}, {}, {}
+    for key, value in values.items():
+        if key in CONTAINER_LABELS or key in ROUTE_LABELS:
+            container[key] = value
+        elif key.startswith('origin.'):
+            origin[key[len('origin.'):]] = value
+        elif key.startswith('routes.') and key.count('.') >= 2:
+            _, route_name, field = key.split('.', 2)
+            if not _ROUTE_NAME.match(route_name):
+                raise LabelError(f"Invalid route name in label cloudflare.{key}")
+            named_routes.setdefault(route_name, {})[field] = value
+        else:
+            warnings.append(f"Ignoring unknown label cloudflare.{key}")
+
+    proxied = container.get('proxied', 'true').strip().lower()
+    if proxied not in ('true', 'false'):
+        warnings.append(f"cloudflare.proxied should be true or false, treating {proxied!r} as false")
+    ttl = _parse_int('ttl', container.get('ttl', '1'))
+    if ttl != 1 and not 60 <= ttl <= 86400:
+        warnings.append(f"cloudflare.ttl should be 1 (automatic) or between 60 and 86400, not {ttl}")
+
+    defaults = {
+        'port': container.get('port'),
+        'scheme': container.get('scheme', 'http'),
+        'host_ip': container.get('host_ip') or host_ip,
+        'path': container.get('path'),
+        'origin': _parse_origin('', origin),
+    }
+    explicit_ports = True
+
+    def route(prefix: str, subdomain: str, fields: dict, validate: bool = True) -> Route:
+        nonlocal explicit_ports
+        scheme = fields.get('scheme', defaults['scheme']).strip().lower()
+        if scheme not in SCHEMES:
+            raise LabelError(f"cloudflare.{prefix}scheme must be one of {', '.join(SCHEMES)}, not {scheme!r}")
+        port = fields.get('port', defaults['port'])
+        if not port:
+            explicit_ports = False
+            port = host_port or '80'
+        path = fields.get('path', defaults['path']) or None
+        if path is not None:
+            if scheme not in PATH_SCHEMES:
+                raise LabelError(f"cloudflare.{prefix}path cannot be used with {scheme} services")
+            path = _parse_path(f'{prefix}path', path)
+        origin_request = dict(defaults['origin'])
+        origin_request.update(_parse_origin(prefix, {
+            key[len('origin.'):]: value for key, value in fields.items() if key.startswith('origin.')
+        }))
+        return Route(
+            subdomain=_parse_subdomain(f'{prefix}subdomain', subdomain) if validate else subdomain.strip().lower(),
+            path=path,
+            scheme=scheme,
+            host_ip=fields.get('host_ip') or defaults['host_ip'],
+            port=_parse_int(f'{prefix}port', port, low=1, high=65535),
+            origin_request=origin_request or None
+        )
+
+    routes = []
+    if 'subdomain' in container or not named_routes:
+        if container.get('subdomain'):
+            subdomains = container['subdomain'].split(',')
+            routes.extend(route('', subdomain, {}) for subdomain in subdomains if subdomain.strip())
+        else:
+            # Only explicit labels are rejected; the container name is used as before
+            if not _SUBDOMAIN.match(name.strip().lower()):
+                warnings.append(f"Container name {name!r} is not a valid DNS name, set cloudflare.subdomain")
+            routes.append(route('', name, {}, validate=False))
+    for route_name, fields in sorted(named_routes.items()):
+        prefix = f'routes.{route_name}.'
+        for field in fields:
+            if field not in ROUTE_LABELS and not field.startswith('origin.'):
+                raise LabelError(f"Unknown label cloudflare.{prefix}{field}")
+        if not fields.get('subdomain'):
+            raise LabelError(f"cloudflare.{prefix}subdomain is required")
+        routes.append(route(prefix, fields['subdomain'], fields))
+
+    if not routes:
+        raise LabelError("cloudflare.subdomain is empty")
+    seen = set()
+    for item in routes:
+        key = (item.subdomain, item.path)
+        if key in seen:
+            raise LabelError(f"Two routes for {item.subdomain}{item.path or ''}")
+        seen.add(key)
+
+    return ContainerLabels(
+        name, True, routes, proxied=proxied == 'true', ttl=ttl,
+        zone=container.get('zone') or None, tunnel=container.get('tunnel') or None,
+        explicit_ports=explicit_ports, warnings=warnings
+    )
+
+def rejected_labels(labels: dict, name: str, error: str) -> ContainerLabels:
+    """Return disabled labels for a container whose labels failed to parse.
+
+    The subdomains, zone and tunnel it asks for are read as far as possible,
+    so that its existing routes are neither pruned nor removed by the
+    events of other containers.
+    """
+    values = {key[len(LABEL_PREFIX):]: value for key, value in labels.items() if key.startswith(LABEL_PREFIX)}
+    requested = (values.get('subdomain') or name).split(',')
+    requested += [value for key, value in values.items() if key.startswith('routes.') and key.endswith('.subdomain')]
+    return ContainerLabels(
+        name, zone=values.get('zone') or None, tunnel=values.get('tunnel') or None, error=error,
+        reserved=dict.fromkeys(subdomain.strip().lower() for subdomain in requested if subdomain.strip())
+    )
@@ -1,94 +1,491 @@
 import os
+import sys
+import json
+import argparse
+import atexit
+import importlib
 import logging
-from time import sleep
-from cloudflare_manager import CloudflareManager
+import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep, time_ns
+from api_client import ApiClient, TokenBucket
+from docker_fleet import DockerFleet
 from docker_manager import DockerManager
+from event_queue import EventQueue
+import metrics
+import structured_logging
+import tracing
+from state_snapshot import SnapshotGroup, StateSnapshot
 
-# Configure dynamic logging based on environment variable
-logging.basicConfig(
-    level=getattr(logging, os.getenv('LOG_LEVEL', 'INFO').upper()),
-    format='%(asctime)s [%(levelname)s] %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S'
-)
 logger = logging.getLogger('cloudflared-tunnel-manager')
 
-# Ensure logs directory exists
-os.makedirs('/app/logs', exist_ok=True)
-
-# Add file handler with rotation
-log_file = '/app/logs/cloudflared-tunnel-manager.log'
-log_handler = logging.FileHandler(log_file)
-log_handler.setFormatter(logging.Formatter('%(asctime)s [%(levelname)s] %(message)s'))
-logger.addHandler(log_handler)
-
-# Add console handler for container logs
-console_handler = logging.StreamHandler()
-console_handler.setFormatter(logging.Formatter('%(asctime)s [%(levelname)s] %(message)s'))
-logger.addHandler(console_handler)
-
-def main():
-    # Get environment variables
-    required_vars = {
-        'CF_API_TOKEN': os.getenv('CF_API_TOKEN'),
-        'CF_ACCOUNT_ID': os.getenv('CF_ACCOUNT_ID'),
-        'TUNNEL_TOKEN': os.getenv('TUNNEL_TOKEN'),
-        'CF_ZONE_ID': os.getenv('CF_ZONE_ID'),
-        'DOMAIN': os.getenv('DOMAIN'),
+# Modules that import the Cloudflare SDK; they are loaded in the background
+# while the Docker event watchers start
+CLOUDFLARE_MODULES = ('cloudflare_manager', 'reconciler', 'shard_router', 'drift_reconciler')
+
+# Set on SIGTERM or SIGINT to leave the restart loop
+shutdown = threading.Event()
+
+def configure_logging():
+    """Set up JSON logging to stderr and a rotated log file through a background writer."""
+    return structured_logging.configure_logging(
+        level=os.getenv('LOG_LEVEL', 'INFO'),
+        log_file=os.getenv('LOG_FILE', '/app/logs/cloudflared-tunnel-manager.log'),
+        json_format=os.getenv('LOG_FORMAT', 'json').lower() == 'json',
+        max_bytes=int(os.getenv('LOG_MAX_BYTES', str(10 * 1024 * 1024))),
+        backup_count=int(os.getenv('LOG_BACKUP_COUNT', '5')),
+        rotate_when=os.getenv('LOG_ROTATE_WHEN') or None,
+        rate_burst=int(os.getenv('LOG_RATE_BURST', '10')),
+        rate_interval=float(os.getenv('LOG_RATE_INTERVAL', '60'))
+    )
+
+def configure_tracing():
+    """Export a trace per container event to TRACE_FILE and/or an OpenTelemetry collector."""
+    exporters = []
+    trace_file = os.getenv('TRACE_FILE')
+    if trace_file:
+        exporters.append(tracing.JsonFileExporter(trace_file, max_bytes=int(os.getenv('TRACE_MAX_BYTES', str(50 * 1024 * 1024)))))
+
+    # Standard OpenTelemetry exporter settings
+    endpoint = os.getenv('OTEL_EXPORTER_OTLP_TRACES_ENDPOINT')
+    if not endpoint and os.getenv('OTEL_EXPORTER_OTLP_ENDPOINT'):
+        endpoint = os.getenv('OTEL_EXPORTER_OTLP_ENDPOINT').rstrip('/') + '/v1/traces'
+    if endpoint:
+        headers = dict(
+            pair.split('=', 1) for pair in os.getenv('OTEL_EXPORTER_OTLP_HEADERS', '').split(',') if '=' in pair
+        )
+        exporters.append(tracing.OtlpHttpExporter(
+            endpoint,
+            service_name=os.getenv('OTEL_SERVICE_NAME', 'cloudflared-tunnel-manager'),
+            headers={key.strip(): value.strip() for key, value in headers.items()}
+        ))
+
+    if not exporters:
+        return None
+    tracer = tracing.configure(exporters, sample_rate=float(os.getenv('TRACE_SAMPLE_RATE', '1')))
+    atexit.register(tracer.flush)
+    logger.info(f"Tracing container events to {len(exporters)} exporter(s)")
+    return tracer
+
+def preload_cloudflare_modules() -> threading.Thread:
+    """Import the Cloudflare SDK and the modules using it on a background thread."""
+    def load():
+        try:
+            for name in CLOUDFLARE_MODULES:
+                importlib.import_module(name)
+        except Exception as e:
+            # Raised again where the module is actually imported
+            logger.debug(f"Preloading Cloudflare modules failed: {str(e)}")
+
+    thread = threading.Thread(target=load, name='preload-cloudflare', daemon=True)
+    thread.start()
+    return thread
+
+def build_api_client(share: int = 1) -> ApiClient:
+    """Create a rate-limited Cloudflare API client from the environment.
+
+    `share` is the number of shards using the same API token; Cloudflare's
+    limit applies per token, so each of them gets an equal part of it.
+    """
+    return ApiClient(
+        TokenBucket(
+            rate=float(os.getenv('CF_RATE_LIMIT', '1200')) / 300 / share,
+            burst=max(1, int(os.getenv('CF_RATE_BURST', '100')) // share)
+        ),
+        max_retries=int(os.getenv('CF_MAX_RETRIES', '5')),
+        retry_max_delay=float(os.getenv('CF_RETRY_MAX_DELAY', '60'))
+    )
+
+# Settings every shard needs, with the environment variables of the single-shard setup
+REQUIRED_SETTINGS = {
+    'api_token': 'CF_API_TOKEN',
+    'account_id': 'CF_ACCOUNT_ID',
+    'tunnel_token': 'TUNNEL_TOKEN',
+    'zone_id': 'CF_ZONE_ID',
+    'domain': 'DOMAIN',
+}
+
+def load_shard_configs() -> list:
+    """Read the tunnel/zone shards from CF_SHARDS, or a single one from the environment.
+
+    CF_SHARDS is a JSON list of objects with `name`, `tunnel_token`, `zone_id`
+    and `domain`, and optionally `api_token`, `account_id`, `host_ip` and
+    `state_file`, which otherwise default to the global settings.
+    """
+    defaults = {
+        'api_token': os.getenv('CF_API_TOKEN'),
+        'account_id': os.getenv('CF_ACCOUNT_ID'),
+        'host_ip': os.getenv('HOST_IP', 'localhost'),
     }
+    shards_json = os.getenv('CF_SHARDS')
+    if not shards_json:
+        return [{
+            **defaults,
+            'name': 'default',
+            'tunnel_token': os.getenv('TUNNEL_TOKEN'),
+            'zone_id': os.getenv('CF_ZONE_ID'),
+            'domain': os.getenv('DOMAIN'),
+        }]
+
+    configs = []
+    for i, shard in enumerate(json.loads(shards_json)):
+        config = {**defaults, **shard}
+        config.setdefault('name', config.get('domain') or f'shard{i}')
+        configs.append(config)
+    return configs
+
+def load_docker_hosts() -> list:
+    """Read the Docker hosts to watch from DOCKER_HOSTS, defaulting to the local socket.
+
+    DOCKER_HOSTS is a JSON list of objects with `name`, `url` (unix://,
+    tcp:// or ssh://) and optionally `host_ip`, the address of the host in
+    ingress service URLs, which otherwise defaults to HOST_IP.
+    """
+    hosts_json = os.getenv('DOCKER_HOSTS')
+    if not hosts_json:
+        return [{'name': 'local', 'url': 'unix://var/run/docker.sock', 'host_ip': None}]
+    hosts = []
+    for i, host in enumerate(json.loads(hosts_json)):
+        hosts.append({
+            'name': host.get('name') or f'host{i}',
+            'url': host['url'],
+            'host_ip': host.get('host_ip'),
+        })
+    return hosts
 
-    # Check for missing variables
-    missing_vars = [k for k, v in required_vars.items() if not v]
+def shard_state_file(state_file: str, config: dict, shard_count: int) -> str:
+    """Return the state snapshot path of a shard; one file per shard when there are several."""
+    if config.get('state_file') or not state_file or shard_count == 1:
+        return config.get('state_file') or state_file
+    root, ext = os.path.splitext(state_file)
+    return f"{root}-{config['name']}{ext}"
+
+def register_metrics(router, docker_fleet):
+    """Expose cache, queue and push scheduler state of the current managers."""
+    def total(read):
+        return lambda: sum(read(cf_manager) for _, cf_manager in router)
+
+    metrics.counter_function(
+        'tunnel_manager_dns_cache_hits_total', 'DNS record index lookups served from cache.',
+        total(lambda cf_manager: cf_manager.dns_record_cache.hits)
+    )
+    metrics.counter_function(
+        'tunnel_manager_dns_cache_misses_total', 'DNS record index lookups not found in cache.',
+        total(lambda cf_manager: cf_manager.dns_record_cache.misses)
+    )
+    metrics.counter_function(
+        'tunnel_manager_container_cache_hits_total', 'Container label lookups served from cache.',
+        lambda: docker_fleet.cache_hits
+    )
+    metrics.counter_function(
+        'tunnel_manager_container_cache_misses_total', 'Container label lookups not found in cache.',
+        lambda: docker_fleet.cache_misses
+    )
+    metrics.gauge_function(
+        'tunnel_manager_event_queue_depth', 'Container events waiting to be applied.',
+        docker_fleet.event_queue.depth
+    )
+    metrics.gauge_function(
+        'tunnel_manager_event_queue_lag_seconds', 'Age of the oldest queued container event.',
+        docker_fleet.event_queue.lag
+    )
+    metrics.counter_function(
+        'tunnel_manager_event_queue_collapsed_total', 'Container events collapsed into a newer event.',
+        lambda: docker_fleet.event_queue.collapsed
+    )
+    metrics.gauge_function(
+        'tunnel_manager_push_pending_changes', 'Changes waiting for the next tunnel config push.',
+        total(lambda cf_manager: cf_manager.push_scheduler.stats()['pending'])
+    )
+    metrics.counter_function(
+        'tunnel_manager_push_coalesced_events_total', 'Changes folded into tunnel config pushes.',
+        total(lambda cf_manager: cf_manager.push_scheduler.events_coalesced)
+    )
+    metrics.gauge_function(
+        'tunnel_manager_cloudflare_rate_limit_tokens', 'Cloudflare API requests available without waiting.',
+        total(lambda cf_manager: cf_manager.api.bucket.available())
+    )
+
+def check_settings(shard_configs: list) -> None:
+    """Raise ValueError if any shard lacks a required setting."""
+    missing_vars = []
+    for config in shard_configs:
+        for key, env_name in REQUIRED_SETTINGS.items():
+            if not config.get(key):
+                missing_vars.append(f"{key} of shard '{config['name']}'" if os.getenv('CF_SHARDS') else env_name)
     if missing_vars:
         logger.error(f"Missing required environment variables: {', '.join(missing_vars)}")
         raise ValueError("Missing required environment variables")
 
-    # Initialize managers
-    cf_manager = CloudflareManager(
-        api_token=required_vars['CF_API_TOKEN'],
-        account_id=required_vars['CF_ACCOUNT_ID'],
-        tunnel_token=required_vars['TUNNEL_TOKEN'],
-        zone_id=required_vars['CF_ZONE_ID'],
-        domain=required_vars['DOMAIN'],
-        host_ip=os.getenv('HOST_IP', 'localhost')
-    )
-    docker_manager = DockerManager()
+def build_snapshots(shard_configs: list, use_snapshots: bool = True) -> list:
+    """Return the state snapshot of each shard, or None for shards without one."""
+    # Persisted state lets restarts skip the full DNS listing
+    state_file = os.getenv('STATE_FILE', '/app/logs/tunnel-manager-state.json') if use_snapshots else None
+    state_max_age = float(os.getenv('STATE_MAX_AGE', '86400'))
+    snapshots = []
+    for config in shard_configs:
+        path = shard_state_file(state_file, config, len(shard_configs))
+        snapshots.append(StateSnapshot(path, max_age=state_max_age) if path else None)
+    return snapshots
+
+def build_router(shard_configs: list, api_clients: dict, snapshots: list, client=None):
+    """Create one Cloudflare manager per tunnel/zone shard, loading their state concurrently.
+
+    `client` replaces the Cloudflare SDK client of every shard (e.g. the
+    benchmark fake).
+    """
+    from cloudflare_manager import CloudflareManager
+    from shard_router import ShardRouter
+
+    for config in shard_configs:
+        if config['name'] not in api_clients:
+            share = sum(1 for other in shard_configs if other['api_token'] == config['api_token'])
+            api_clients[config['name']] = build_api_client(share)
+
+    def create(config: dict, snapshot) -> CloudflareManager:
+        return CloudflareManager(
+            api_token=config['api_token'],
+            account_id=config['account_id'],
+            tunnel_token=config['tunnel_token'],
+            zone_id=config['zone_id'],
+            domain=config['domain'],
+            host_ip=config['host_ip'],
+            push_quiet_window=float(os.getenv('PUSH_QUIET_WINDOW', '2')),
+            push_max_delay=float(os.getenv('PUSH_MAX_DELAY', '10')),
+            dns_refresh_interval=float(os.getenv('DNS_REFRESH_INTERVAL', '3600')),
+            snapshot=snapshot,
+            api_client=api_clients[config['name']],
+            client=client
+        )
 
-    logger.info("Starting DNS Manager...")
-    
-    # Initial setup - cache DNS records and process existing containers
+    with ThreadPoolExecutor(max_workers=len(shard_configs), thread_name_prefix='shard-init') as pool:
+        managers = list(pool.map(create, shard_configs, snapshots))
+    return ShardRouter({config['name']: cf_manager for config, cf_manager in zip(shard_configs, managers)})
+
+def build_docker_fleet(snapshots: list, clients: dict = None) -> DockerFleet:
+    """Create one event reader per Docker host, all feeding one queue that serves all shards.
+
+    `clients` maps host names to Docker clients to use instead of connecting
+    (e.g. the benchmark fake).
+    """
+    clients = clients or {}
+    event_queue = EventQueue(maxsize=int(os.getenv('EVENT_QUEUE_SIZE', '1000')))
+    return DockerFleet([
+        DockerManager(
+            snapshot=SnapshotGroup(snapshots) if any(snapshots) else None,
+            reconnect_max_delay=float(os.getenv('DOCKER_RECONNECT_MAX_DELAY', '60')),
+            event_retention=float(os.getenv('DOCKER_EVENT_RETENTION', '900')),
+            event_workers=int(os.getenv('EVENT_WORKERS', '4')),
+            client=clients.get(host['name']),
+            name=host['name'],
+            base_url=host['url'],
+            host_ip=host['host_ip'],
+            event_queue=event_queue
+        )
+        for host in load_docker_hosts()
+    ])
+
+def start(shard_configs: list, api_clients: dict, cf_client=None, docker_clients: dict = None):
+    """Start the manager; return the router, Docker fleet and drift reconcilers once events are applied.
+
+    Docker events are read from the very start and buffered in the event
+    queue while the Cloudflare SDK is imported and the state of all shards
+    is loaded concurrently. Buffered events are applied after the initial
+    reconciliation, which also covers any events missed while stopped.
+    """
+    preload = preload_cloudflare_modules()
+    snapshots = build_snapshots(shard_configs)
+    docker_fleet = build_docker_fleet(snapshots, clients=docker_clients)
+
+    ready = threading.Event()
+
+    def on_gap():
+        # Gaps found before the initial reconciliation are covered by it
+        if ready.is_set():
+            reconcile_containers()
+
+    docker_fleet.start_watching(on_gap=on_gap)
+    logger.info(f"Watching container events on {len(docker_fleet)} Docker host(s), loading Cloudflare state")
+
+    preload.join()
+    from drift_reconciler import DriftReconciler
     try:
-        # First get all existing DNS records and tunnel config
-        cf_manager.get_dns_records()
-        cf_manager.get_tunnel_config()
-        
-        # Process existing containers
-        containers = docker_manager.get_running_containers()
-        logger.info(f"Found {len(containers)} running containers")
+        router = build_router(shard_configs, api_clients, snapshots, client=cf_client)
+    except Exception:
+        docker_fleet.stop()
+        raise
+
+    reconcile_workers = int(os.getenv('RECONCILE_WORKERS', '8'))
+    reconcile_prune = os.getenv('RECONCILE_PRUNE', 'false').lower() == 'true'
+
+    def reconcile_containers():
+        """Diff all running containers against the cached state and apply the differences."""
+        listed_at = time_ns()
+
+        # Apply only the differences and send a single tunnel configuration update per shard
+        router.reconcile(
+            docker_fleet.running_container_labels(),
+            max_workers=reconcile_workers,
+            prune=reconcile_prune
+        )
+        router.save_snapshot()
+        # Events before the listing are already reflected in the reconciled state
+        docker_fleet.resume_from(listed_at)
+
+    # Periodically repair changes made outside the manager
+    drift_reconcilers = [
+        DriftReconciler(
+            cf_manager,
+            lambda name=name: router.split(docker_fleet.running_container_labels())[name],
+            interval=float(os.getenv('DRIFT_CHECK_INTERVAL', '300')),
+            prune=reconcile_prune,
+            max_workers=reconcile_workers
+        )
+        for name, cf_manager in router
+    ]
 
-        # Process DNS records and cache tunnel config updates
-        for container in containers:
-            logger.debug(f"Processing existing container: {container.name}")
-            labels = docker_manager.get_container_labels(container)
-            if labels.get('enabled', False):
-                cf_manager.update_dns_record(labels)
-                cf_manager.update_tunnel_config(labels)
+    register_metrics(router, docker_fleet)
 
-        # Send the final tunnel configuration update
-        cf_manager.push_tunnel_config()
+    logger.info(f"Starting DNS Manager for {len(router)} tunnel/zone shard(s) and {len(docker_fleet)} Docker host(s)...")
+
+    # Initial setup - DNS records and tunnel config were cached by the
+    # managers, so only process existing containers here
+    try:
+        # Process existing containers
+        reconcile_containers()
 
     except Exception as e:
         logger.error(f"Error during initial setup: {str(e)}")
+        docker_fleet.stop()
+        router.close()
         raise
 
-    # Watch for container events
-    logger.info("Starting container event monitoring")
-    docker_manager.watch_events(cf_manager.handle_container_update)
+    # Apply the buffered and all further container events
+    logger.info("Starting container event processing")
+    ready.set()
+    docker_fleet.start_workers(router.handle_container_update)
+    for drift_reconciler in drift_reconcilers:
+        drift_reconciler.start()
+    return router, docker_fleet, drift_reconcilers
+
+def main(api_clients: dict = None):
+    """Run the manager until the Docker event watchers stop.
 
+    `api_clients` maps shard names to their API clients and is kept by the
+    caller across restarts, so a restart does not reset the request budgets.
+    """
+    api_clients = {} if api_clients is None else api_clients
+    shard_configs = load_shard_configs()
+    check_settings(shard_configs)
+
+    router, docker_fleet, drift_reconcilers = start(shard_configs, api_clients)
+
+    def stop(signum, frame):
+        # Stopping the watchers unwinds through close(), which pushes pending changes
+        logger.info(f"Received {signal.Signals(signum).name}, shutting down")
+        shutdown.set()
+        docker_fleet.stop()
+
+    previous = {signum: signal.signal(signum, stop) for signum in (signal.SIGTERM, signal.SIGINT)}
+    try:
+        docker_fleet.wait()
+    finally:
+        for signum, handler in previous.items():
+            signal.signal(signum, handler)
+        for drift_reconciler in drift_reconcilers:
+            drift_reconciler.stop()
+        docker_fleet.stop()
+        router.close()
+
+def format_plan(plans: dict) -> str:
+    """Render the per-shard plans as text, one line per operation."""
+    symbols = {'create': '+', 'edit': '~', 'delete': '-'}
+    lines = []
+    for name, shard_plan in plans.items():
+        lines.append(f"Shard {name} ({shard_plan['domain']}):")
+        for detail in shard_plan['changes']:
+            line = f"  {symbols[detail['action']]} {detail['kind']:<8}{detail['hostname']}{detail.get('path') or ''}"
+            if 'fields' in detail:
+                line += ': ' + ', '.join(f"{field} {old!r} -> {new!r}" for field, (old, new) in detail['fields'].items())
+            elif isinstance(detail.get('service'), list):
+                line += f": {detail['service'][0]} -> {detail['service'][1]}"
+            elif detail.get('service'):
+                line += f" -> {detail['service']}"
+            lines.append(line)
+        lines.append(
+            f"  {shard_plan['dns_creates']} DNS records to create, {shard_plan['dns_edits']} to edit, "
+            f"{shard_plan['dns_deletes']} to delete, {shard_plan['ingress_upserts']} ingress rules to set, "
+            f"{shard_plan['ingress_removals']} to remove ({shard_plan['api_calls']} API calls)"
+        )
+    total = sum(shard_plan['api_calls'] for shard_plan in plans.values())
+    lines.append(f"Plan: {total} API calls across {len(plans)} shard(s); nothing was written.")
+    return '\n'.join(lines)
+
+def plan(argv: list = None) -> int:
+    """Print the changes a reconcile would make for the running containers, without writing.
+
+    Uses the same configuration and diff as the daemon; only reads the
+    Docker hosts and the Cloudflare state.
+    """
+    parser = argparse.ArgumentParser(
+        prog='main.py plan', description='Show the DNS and ingress changes a reconcile would make.'
+    )
+    parser.add_argument('--json', action='store_true', help='print the plan as JSON')
+    parser.add_argument('--refresh', action='store_true', help='list DNS records instead of using the state snapshot')
+    args = parser.parse_args(argv)
+
+    # Keep stdout for the plan itself unless more logging was asked for
+    if not os.getenv('LOG_LEVEL'):
+        logging.getLogger().setLevel(logging.WARNING)
+
+    from reconciler import change_details, desired_state, plan_changes
+
+    shard_configs = load_shard_configs()
+    check_settings(shard_configs)
+    reconcile_prune = os.getenv('RECONCILE_PRUNE', 'false').lower() == 'true'
+
+    router = build_router(shard_configs, {}, build_snapshots(shard_configs, use_snapshots=not args.refresh))
+    try:
+        groups = router.split(build_docker_fleet([]).running_container_labels())
+        plans = {}
+        for name, cf_manager in router:
+            if cf_manager.dns_record_cache.is_stale():
+                cf_manager.get_dns_records()
+            changes = plan_changes(cf_manager, desired_state(groups[name]), prune=reconcile_prune)
+            plans[name] = {
+                'domain': cf_manager.domain,
+                'tunnel_id': cf_manager.tunnel_id,
+                **changes.summary(),
+                'changes': change_details(cf_manager, changes),
+            }
+    finally:
+        # A daemon may be running with the same state file; leave it alone
+        router.close(save=False)
+
+    print(json.dumps(plans, indent=2, default=str) if args.json else format_plan(plans))
+    return 0
 
 if __name__ == '__main__':
-    while True:
+    configure_logging()
+    configure_tracing()
+    if sys.argv[1:2] == ['plan']:
+        sys.exit(plan(sys.argv[2:]))
+
+    metrics_port = os.getenv('METRICS_PORT', '9101')
+    if metrics_port and metrics_port != '0':
+        metrics.start_metrics_server(int(metrics_port))
+
+    # Shared across restarts so a restart does not reset the request budgets
+    api_clients = {}
+
+    # Until main() installs its own handler, stop like on Ctrl-C; as PID 1
+    # in a container, SIGTERM is otherwise ignored until the SIGKILL
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    while not shutdown.is_set():
         try:
-            main()
+            main(api_clients)
         except Exception as e:
             logger.critical(f"Critical error in main loop: {str(e)}")
             logger.info("Restarting in 5 seconds...")
@@ -0,0 +1,258 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable
+
+logger = logging.getLogger('dns-manager')
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labelnames: tuple, values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _Metric:
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}')
+        return lines
+
+class Counter(_Metric):
+    """Monotonically increasing value, optionally split by labels."""
+
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(_Metric):
+    """Value that can go up and down, optionally read from a callback."""
+
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        super().__init__(name, documentation, labelnames)
+        self._function = None
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        """Read the (unlabelled) value from `function` at scrape time."""
+        self._function = function
+
+    def render(self) -> list:
+        if self._function is not None:
+            try:
+                self.set(self._function())
+            except Exception as e:
+                logger.debug(f"Failed to read metric {self.name}: {str(e)}")
+        return super().render()
+
+class CounterFunction(Gauge):
+    """Counter whose value is read from a callback at scrape time."""
+
+    type = 'counter'
+
+class Histogram(_Metric):
+    """Distribution of observed values in cumulative buckets."""
+
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the wrapped block."""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, counts):
+                    le = _format_labels(self.labelnames, key, f'le="{_format_value(bound)}"')
+                    lines.append(f'{self.name}_bucket{le} {count}')
+                labels = _format_labels(self.labelnames, key)
+                lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+                lines.append(f'{self.name}_count{labels} {counts[-1]}')
+        return lines
+
+class Registry:
+    """Collection of metrics rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        # Re-registering a name replaces it, e.g. callbacks after a restart
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+def counter(name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+def gauge(name: str, documentation: str, labelnames: tuple = ()) -> Gauge:
+    return REGISTRY.register(Gauge(name, documentation, labelnames))
+
+def histogram(name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+    return REGISTRY.register(Histogram(name, documentation, labelnames, buckets))
+
+def gauge_function(name: str, documentation: str, function: Callable[[], float]) -> Gauge:
+    metric = Gauge(name, documentation)
+    metric.set_function(function)
+    return REGISTRY.register(metric)
+
+def counter_function(name: str, documentation: str, function: Callable[[], float]) -> CounterFunction:
+    metric = CounterFunction(name, documentation)
+    metric.set_function(function)
+    return REGISTRY.register(metric)
+
+# Metrics shared across the managers
+CF_API_LATENCY = histogram(
+    'tunnel_manager_cloudflare_api_seconds',
+    'Latency of Cloudflare API calls by operation and outcome.',
+    ('operation', 'outcome')
+)
+CF_API_RETRIES = counter(
+    'tunnel_manager_cloudflare_api_retries_total',
+    'Retried Cloudflare API calls by operation and reason.',
+    ('operation', 'reason')
+)
+CF_API_THROTTLED = counter(
+    'tunnel_manager_cloudflare_api_throttled_total',
+    'Cloudflare API calls rejected with 429 Too Many Requests.',
+    ('operation',)
+)
+CF_RATE_LIMIT_WAIT = histogram(
+    'tunnel_manager_cloudflare_rate_limit_wait_seconds',
+    'Time Cloudflare API calls waited for a rate limit token, by priority lane.',
+    ('lane',),
+    buckets=(0.001, 0.01, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+)
+DNS_CHANGES = counter(
+    'tunnel_manager_dns_changes_total',
+    'DNS record writes by action.',
+    ('action',)
+)
+DNS_FOREIGN_RECORDS = counter(
+    'tunnel_manager_dns_foreign_records_total',
+    'Container hostnames left alone because their DNS record is not managed by this manager.'
+)
+TUNNEL_PUSHES = counter(
+    'tunnel_manager_tunnel_pushes_total',
+    'Tunnel configuration pushes by outcome.',
+    ('outcome',)
+)
+TUNNEL_CONFIG_CONFLICTS = counter(
+    'tunnel_manager_tunnel_config_conflicts_total',
+    'Tunnel configuration changes made elsewhere, found when pushing, by kind.',
+    ('kind',)
+)
+EVENT_APPLY_LATENCY = histogram(
+    'tunnel_manager_event_apply_seconds',
+    'Time from a Docker event being emitted to it being applied.',
+    ('action',),
+    buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+)
+DRIFT_CHECKS = counter(
+    'tunnel_manager_drift_checks_total',
+    'Periodic drift checks by outcome.',
+    ('outcome',)
+)
+DRIFT_REPAIRS = counter(
+    'tunnel_manager_drift_repairs_total',
+    'DNS records and ingress rules repaired after drifting, by kind.',
+    ('kind',)
+)
+DOCKER_RECONNECTS = counter(
+    'tunnel_manager_docker_reconnects_total',
+    'Reconnects of the Docker event stream.'
+)
+INVALID_LABELS = counter(
+    'tunnel_manager_invalid_labels_total',
+    'Containers ignored because their Cloudflare labels are invalid.'
+)
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/metrics', '/'):
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(f"Metrics request: {format % args}")
+
+_server = None
+
+def start_metrics_server(port: int, addr: str = '0.0.0.0'):
+    """Serve /metrics on a daemon thread. Only the first call starts a server."""
+    global _server
+    if _server is not None:
+        return _server
+    _server = ThreadingHTTPServer((addr, port), _MetricsHandler)
+    threading.Thread(target=_server.serve_forever, name='metrics-server', daemon=True).start()
+    logger.info(f"Serving Prometheus metrics on {addr}:{port}/metrics")
+    return _server
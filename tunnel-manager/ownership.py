@@ -0,0 +1,61 @@
+import threading
+
+from dns_record_index import summarize
+
+# Comment written on every DNS record the manager creates
+MANAGED_COMMENT = 'managed via cloudflared-tunnel-manager'
+
+class OwnershipRegistry:
+    """Which DNS records belong to this manager.
+
+    Ownership is kept in Cloudflare itself: a record is owned when it carries
+    the managed comment and points at this manager's tunnel. It therefore
+    survives restarts, and listings can ask Cloudflare for owned records
+    only. Records found under a container's hostname that are not owned are
+    remembered as foreign, so that further events for that hostname cost no
+    API calls; they are forgotten on the next full DNS refresh.
+    """
+
+    def __init__(self, target: str, marker: str = MANAGED_COMMENT):
+        self.target = target
+        self.marker = marker
+        self._foreign = {}
+        self._lock = threading.Lock()
+
+    def owns(self, record) -> bool:
+        """Return True if a DNS record carries the marker and points at the tunnel."""
+        return (
+            record is not None
+            and getattr(record, 'comment', None) == self.marker
+            and getattr(record, 'content', None) == self.target
+        )
+
+    def list_filters(self) -> dict:
+        """DNS listing parameters that make Cloudflare return owned records only."""
+        return {'comment': {'exact': self.marker}, 'content': {'exact': self.target}}
+
+    def mark_foreign(self, subdomain: str, record) -> None:
+        with self._lock:
+            self._foreign[subdomain] = summarize(record)
+
+    def is_foreign(self, subdomain: str) -> bool:
+        return subdomain in self._foreign
+
+    def forget_foreign(self) -> None:
+        with self._lock:
+            self._foreign = {}
+
+    def foreign(self) -> dict:
+        """Return the foreign records by subdomain."""
+        with self._lock:
+            return dict(self._foreign)
+
+    def restore_foreign(self, records: dict) -> None:
+        with self._lock:
+            self._foreign = {
+                subdomain: record for subdomain, record in records.items()
+                if not self.owns(record)
+            }
+
+    def __len__(self) -> int:
+        return len(self._foreign)
@@ -0,0 +1,173 @@
+import logging
+import threading
+import time
+from typing import Callable
+
+from metrics import EVENT_APPLY_LATENCY
+import tracing
+
+logger = logging.getLogger('dns-manager')
+
+# Container event traces linked from one push span at most
+MAX_TRACE_LINKS = 128
+# Event times kept for the apply latency of one push at most
+MAX_EVENT_TIMES = 10000
+
+class PushScheduler:
+    """Coalesce tunnel configuration pushes into one PUT per burst of changes.
+
+    Every call to `mark_dirty` records a pending change. The push is sent once
+    no further changes have arrived for `quiet_window` seconds, or once the
+    oldest pending change is `max_delay` seconds old, whichever comes first.
+    The Docker events behind the changes count as applied once it succeeds.
+    """
+
+    def __init__(self, push: Callable[[], None], quiet_window: float = 2.0, max_delay: float = 10.0):
+        self.push = push
+        self.quiet_window = max(0.0, quiet_window)
+        self.max_delay = max(self.quiet_window, max_delay)
+
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = False
+        self._pending = 0
+        self._first_dirty = None
+        self._last_dirty = None
+        self._links = []
+        self._event_times = []
+
+        # Counters
+        self.pushes = 0
+        self.failed_pushes = 0
+        self.events_received = 0
+        self.events_coalesced = 0
+        self.last_batch_size = 0
+        self.max_batch_size = 0
+
+    def mark_dirty(self, reason: str = None, event_time: int = None, action: str = None) -> None:
+        """Record a pending change and schedule a push.
+
+        `event_time` is the timeNano of the Docker event behind the change,
+        its `action` labels the apply latency observed after the push.
+        """
+        with self._cond:
+            now = time.monotonic()
+            if not self._pending:
+                self._first_dirty = now
+            self._pending += 1
+            self._last_dirty = now
+            self.events_received += 1
+            context = tracing.current_span().context()
+            if context and len(self._links) < MAX_TRACE_LINKS:
+                self._links.append(context)
+            if event_time and len(self._event_times) < MAX_EVENT_TIMES:
+                self._event_times.append((event_time, action))
+            if reason:
+                logger.debug("Tunnel config marked dirty: %s (%d pending)", reason, self._pending)
+            self._ensure_thread()
+            self._cond.notify_all()
+
+    def flush(self) -> bool:
+        """Push pending changes immediately. Returns True if a push was sent."""
+        with self._cond:
+            batch, links, event_times = self._take_batch()
+        if not batch:
+            return False
+        self._push(batch, links, event_times)
+        return True
+
+    def stop(self, flush: bool = True) -> None:
+        """Stop the background thread, optionally pushing pending changes first."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+            thread = self._thread
+        if thread and thread is not threading.current_thread():
+            thread.join(timeout=self.max_delay + 5)
+        if flush:
+            self.flush()
+
+    def stats(self) -> dict:
+        """Return a snapshot of the scheduler counters."""
+        with self._cond:
+            return {
+                'pending': self._pending,
+                'pushes': self.pushes,
+                'failed_pushes': self.failed_pushes,
+                'events_received': self.events_received,
+                'events_coalesced': self.events_coalesced,
+                'last_batch_size': self.last_batch_size,
+                'max_batch_size': self.max_batch_size,
+            }
+
+    def _ensure_thread(self) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            self._stopped = False
+            self._thread = threading.Thread(
+                target=self._run, name='tunnel-push-scheduler', daemon=True
+            )
+            self._thread.start()
+
+    def _take_batch(self) -> tuple:
+        """Return the number of pending changes and the traces and times of the events behind them."""
+        batch, links, event_times = self._pending, self._links, self._event_times
+        self._pending = 0
+        self._first_dirty = None
+        self._last_dirty = None
+        self._links = []
+        self._event_times = []
+        return batch, links, event_times
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+
+                now = time.monotonic()
+                deadline = min(
+                    self._last_dirty + self.quiet_window,
+                    self._first_dirty + self.max_delay
+                )
+                if now < deadline:
+                    self._cond.wait(timeout=deadline - now)
+                    continue
+
+                batch, links, event_times = self._take_batch()
+
+            self._push(batch, links, event_times)
+
+    def _push(self, batch: int, links: list, event_times: list) -> None:
+        try:
+            with tracing.span('coalesced push', batch=batch) as span:
+                for context in links:
+                    span.add_link(context)
+                self.push()
+        except Exception as e:
+            # Keep the changes pending so the next window retries them
+            logger.error(f"Coalesced tunnel config push failed, will retry: {str(e)}")
+            with self._cond:
+                self.failed_pushes += 1
+                now = time.monotonic()
+                if not self._pending:
+                    self._first_dirty = now
+                self._pending += batch
+                self._last_dirty = now
+                self._links = (links + self._links)[:MAX_TRACE_LINKS]
+                self._event_times = (event_times + self._event_times)[:MAX_EVENT_TIMES]
+                if not self._stopped:
+                    self._ensure_thread()
+                    self._cond.notify_all()
+            return
+
+        with self._cond:
+            self.pushes += 1
+            self.events_coalesced += batch
+            self.last_batch_size = batch
+            self.max_batch_size = max(self.max_batch_size, batch)
+        now = time.time_ns()
+        for event_time, action in event_times:
+            EVENT_APPLY_LATENCY.observe(max(0.0, (now - event_time) / 1e9), action=action)
+        logger.info(f"Pushed tunnel configuration for {batch} coalesced change(s)")
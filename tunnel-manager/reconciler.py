@@ -0,0 +1,181 @@
+import contextvars
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Iterable
+
+from api_client import LANE_BULK
+from ingress_table import IngressTable
+from cloudflare_manager import CloudflareManagerBase, DnsChange
+from label_schema import ContainerLabels
+import tracing
+
+logger = logging.getLogger('dns-manager')
+
+class ChangeSet:
+    """Differences between the desired state and the cached Cloudflare state."""
+
+    def __init__(self):
+        self.dns_changes = []
+        self.ingress_upserts = []
+        self.ingress_removals = []
+
+    def __bool__(self) -> bool:
+        return bool(self.dns_changes or self.ingress_upserts or self.ingress_removals)
+
+    def summary(self) -> dict:
+        """Count the planned operations by kind."""
+        counts = {'create': 0, 'edit': 0, 'delete': 0}
+        for change in self.dns_changes:
+            counts[change.action] += 1
+        has_ingress = bool(self.ingress_upserts or self.ingress_removals)
+        return {
+            'dns_creates': counts['create'],
+            'dns_edits': counts['edit'],
+            'dns_deletes': counts['delete'],
+            'ingress_upserts': len(self.ingress_upserts),
+            'ingress_removals': len(self.ingress_removals),
+            # One call per DNS write plus a single tunnel config read and push
+            'api_calls': len(self.dns_changes) + (2 if has_ingress else 0),
+        }
+
+def desired_state(labels_list: Iterable[ContainerLabels]) -> dict:
+    """Map each subdomain of every enabled container to its labels; later containers win.
+
+    Subdomains of containers with rejected labels map to those labels unless
+    a valid container asks for them, so that their routes are left as they are.
+    """
+    desired = {}
+    for labels in labels_list:
+        if not labels:
+            continue
+        if labels.enabled:
+            for subdomain in labels.subdomains:
+                desired[subdomain] = labels
+        for subdomain in labels.reserved:
+            desired.setdefault(subdomain, labels)
+    return desired
+
+def plan_changes(cf_manager: CloudflareManagerBase, desired: dict, prune: bool = False) -> ChangeSet:
+    """Diff the desired state against the manager's DNS index and ingress table.
+
+    With `prune`, DNS records and ingress rules that this manager created
+    (identified by the managed record comment) but that no running container
+    asks for any more are scheduled for deletion, including the rules of
+    paths a container no longer routes.
+    """
+    changes = ChangeSet()
+    desired_keys = set()
+    kept_hostnames = set()
+    records = dict(cf_manager.dns_record_cache.items())
+
+    for subdomain, labels in desired.items():
+        if not labels.enabled or cf_manager.ownership.is_foreign(subdomain):
+            kept_hostnames.add(f"{subdomain}.{cf_manager.domain}")
+            continue
+        dns_change = cf_manager.plan_dns_change(subdomain, labels, records=records)
+        if dns_change:
+            changes.dns_changes.append(dns_change)
+
+        for rule in cf_manager.build_ingress_rules(labels, subdomain):
+            desired_keys.add(IngressTable.key(rule.hostname, rule.path))
+            if cf_manager.ingress_table.get(rule.hostname, rule.path) != rule:
+                changes.ingress_upserts.append(rule)
+
+    if prune:
+        managed_hostnames = set()
+        for subdomain, record in records.items():
+            if not cf_manager.is_managed_record(record):
+                continue
+            managed_hostnames.add(f"{subdomain}.{cf_manager.domain}")
+            if subdomain not in desired:
+                changes.dns_changes.append(DnsChange('delete', subdomain, record=record))
+        for key in cf_manager.ingress_table.keys():
+            if key[0] in managed_hostnames and key[0] not in kept_hostnames and key not in desired_keys:
+                changes.ingress_removals.append(key)
+
+    return changes
+
+def change_details(cf_manager: CloudflareManagerBase, changes: ChangeSet) -> list:
+    """Describe each planned operation as a dict, e.g. for printing a plan."""
+    details = []
+    for change in changes.dns_changes:
+        detail = {'kind': 'dns', 'action': change.action, 'hostname': f"{change.subdomain}.{cf_manager.domain}"}
+        if change.action == 'edit':
+            detail['fields'] = {
+                field: [getattr(change.record, field, None), change.data[field]] for field in change.fields
+            }
+        details.append(detail)
+    for rule in changes.ingress_upserts:
+        current = cf_manager.ingress_table.get(rule.hostname, rule.path)
+        details.append({
+            'kind': 'ingress',
+            'action': 'edit' if current is not None else 'create',
+            'hostname': rule.hostname,
+            'path': rule.path,
+            'service': [current.service, rule.service] if current is not None else rule.service,
+        })
+    for hostname, path in changes.ingress_removals:
+        details.append({'kind': 'ingress', 'action': 'delete', 'hostname': hostname, 'path': path})
+    return details
+
+def apply_changes(cf_manager, changes: ChangeSet, max_workers: int = 8) -> list:
+    """Apply a change set: DNS writes on a bounded worker pool, then one config push.
+
+    DNS writes use the bulk priority lane, so changes from container events
+    are not held up behind a large reconciliation. Returns the list of exceptions raised by individual DNS writes.
+    """
+    errors = []
+    if changes.dns_changes:
+        with ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix='reconcile') as pool:
+            # Each write runs in a copy of the caller's context, so its spans join the caller's trace
+            futures = {
+                pool.submit(contextvars.copy_context().run, cf_manager.apply_dns_change, change, lane=LANE_BULK): change
+                for change in changes.dns_changes
+            }
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    change = futures[future]
+                    logger.error(f"Failed to {change.action} DNS record for {change.subdomain}: {str(e)}")
+                    errors.append(e)
+
+    if cf_manager.apply_ingress_changes(changes.ingress_upserts, changes.ingress_removals):
+        cf_manager.push_tunnel_config()
+
+    return errors
+
+@tracing.traced('reconcile')
+def reconcile(cf_manager, labels_list: Iterable[ContainerLabels], max_workers: int = 8, prune: bool = False) -> dict:
+    """Bring Cloudflare in line with the labels of all running containers."""
+    started = time.monotonic()
+    if cf_manager.dns_record_cache.is_stale():
+        cf_manager.get_dns_records()
+
+    desired = desired_state(labels_list)
+    changes = plan_changes(cf_manager, desired, prune=prune)
+    planned = time.monotonic()
+
+    errors = apply_changes(cf_manager, changes, max_workers=max_workers)
+
+    report = {
+        # desired maps subdomains to labels; count each enabled container once
+        'containers': len({id(labels) for labels in desired.values() if labels.enabled}),
+        **changes.summary(),
+        'errors': len(errors),
+        'plan_seconds': round(planned - started, 3),
+        'total_seconds': round(time.monotonic() - started, 3),
+    }
+    span = tracing.current_span()
+    for key in ('containers', 'api_calls', 'errors'):
+        span.set_attribute(key, report[key])
+    logger.info(
+        f"Reconciled {report['containers']} containers in {report['total_seconds']}s "
+        f"({report['api_calls']} API calls): "
+        f"{report['dns_creates']} created, {report['dns_edits']} edited, {report['dns_deletes']} deleted, "
+        f"{report['ingress_upserts']} ingress rules set, {report['ingress_removals']} removed"
+    )
+    if errors:
+        raise errors[0]
+    return report
@@ -0,0 +1,105 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable
+
+from label_schema import ContainerLabels
+from reconciler import reconcile
+
+logger = logging.getLogger('dns-manager')
+
+class ShardRouter:
+    """Route containers to the CloudflareManager of their tunnel and zone.
+
+    Each shard is a manager for one tunnel/zone pair with its own caches,
+    push scheduler and API rate budget. Containers pick a shard with the
+    `cloudflare.tunnel` label (shard name or tunnel ID) and/or the
+    `cloudflare.zone` label (shard name, domain or zone ID); containers
+    without either label go to the first shard.
+    """
+
+    def __init__(self, shards: dict):
+        if not shards:
+            raise ValueError("At least one tunnel/zone shard is required")
+        tunnels = {}
+        for name, cf_manager in shards.items():
+            if cf_manager.tunnel_id in tunnels:
+                # Two managers pushing one tunnel config would overwrite each other's rules
+                raise ValueError(
+                    f"Shards '{tunnels[cf_manager.tunnel_id]}' and '{name}' use the same tunnel"
+                )
+            tunnels[cf_manager.tunnel_id] = name
+        self.shards = dict(shards)
+        self.default = next(iter(self.shards))
+
+    def shard_for(self, labels: ContainerLabels):
+        """Return the name of the shard a container belongs to, or None if no shard matches."""
+        tunnel = labels.tunnel
+        zone = labels.zone
+        if not tunnel and not zone:
+            return self.default
+        for name, cf_manager in self.shards.items():
+            if tunnel and tunnel not in (name, cf_manager.tunnel_id):
+                continue
+            if zone and zone not in (name, cf_manager.domain, cf_manager.zone_id):
+                continue
+            return name
+        logger.warning(
+            f"No shard for container '{labels.name}' (tunnel={tunnel!r}, zone={zone!r}), ignoring it"
+        )
+        return None
+
+    def split(self, labels_list: Iterable[ContainerLabels]) -> dict:
+        """Group container labels by shard name; every shard gets a (possibly empty) list."""
+        groups = {name: [] for name in self.shards}
+        for labels in labels_list:
+            if not labels:
+                continue
+            name = self.shard_for(labels)
+            if name is not None:
+                groups[name].append(labels)
+        return groups
+
+    def handle_container_update(self, labels: ContainerLabels, action: str = 'start', event_time: int = None):
+        """Apply a container update through the manager of its shard."""
+        name = self.shard_for(labels)
+        if name is None:
+            return False
+        return self.shards[name].handle_container_update(labels, action, event_time=event_time)
+
+    def reconcile(self, labels_list: Iterable[ContainerLabels], max_workers: int = 8, prune: bool = False) -> dict:
+        """Reconcile all shards concurrently; return the report of each shard by name."""
+        groups = self.split(labels_list)
+        with ThreadPoolExecutor(max_workers=len(self.shards), thread_name_prefix='shard') as pool:
+            futures = {
+                name: pool.submit(reconcile, self.shards[name], groups[name], max_workers=max_workers, prune=prune)
+                for name in self.shards
+            }
+        reports, errors = {}, []
+        for name, future in futures.items():
+            try:
+                reports[name] = future.result()
+            except Exception as e:
+                logger.error(f"Reconciliation of shard '{name}' failed: {str(e)}")
+                errors.append(e)
+        if errors:
+            raise errors[0]
+        return reports
+
+    def save_snapshot(self) -> None:
+        for cf_manager in self.shards.values():
+            cf_manager.save_snapshot()
+
+    def flush_tunnel_config(self) -> bool:
+        """Push pending tunnel configuration changes of all shards."""
+        results = [cf_manager.flush_tunnel_config() for cf_manager in self.shards.values()]
+        return any(results)
+
+    def close(self, save: bool = True) -> None:
+        for cf_manager in self.shards.values():
+            cf_manager.close(save=save)
+
+    def __iter__(self):
+        return iter(self.shards.items())
+
+    def __len__(self) -> int:
+        return len(self.shards)
@@ -0,0 +1,138 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from dns_record_index import DnsRecordSummary
+
+logger = logging.getLogger('dns-manager')
+
+class StateSnapshot:
+    """Persist manager state between restarts as a JSON file.
+
+    The snapshot holds the DNS record index, the records found to belong to
+    someone else, the version of the tunnel configuration it was taken
+    against and the time of the last processed event of each Docker host.
+    Writes go to a temporary file that is atomically renamed over the
+    previous snapshot, so a crash never leaves a partial file.
+    """
+
+    FORMAT = 2
+
+    def __init__(self, path: str, max_age: float = 86400):
+        self.path = path
+        self.max_age = max_age
+        self.last_event_times = {}
+        self._lock = threading.Lock()
+
+    def load(self, zone_id: str, tunnel_id: str, domain: str):
+        """Return the saved state if it is usable for this zone and tunnel, else None."""
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            logger.info(f"No state snapshot found at {self.path}")
+            return None
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable state snapshot {self.path}: {str(e)}")
+            return None
+
+        age = time.time() - state.get('saved_at', 0)
+        if state.get('format') != self.FORMAT:
+            reason = f"format {state.get('format')}"
+        elif (state.get('zone_id'), state.get('tunnel_id'), state.get('domain')) != (zone_id, tunnel_id, domain):
+            reason = "it belongs to a different zone, tunnel or domain"
+        elif self.max_age and age > self.max_age:
+            reason = f"it is {int(age)}s old"
+        else:
+            reason = None
+
+        if reason:
+            logger.info(f"Ignoring state snapshot {self.path}: {reason}")
+            return None
+
+        state['age'] = max(0.0, age)
+        for host, time_nano in state.get('last_event_times', {}).items():
+            self.last_event_times.setdefault(host, time_nano)
+        logger.info(f"Loaded state snapshot with {len(state.get('dns_records', []))} DNS records ({int(age)}s old)")
+        return state
+
+    def event_time(self, host: str):
+        """Return the time of the last processed event of a Docker host, or None."""
+        return self.last_event_times.get(host)
+
+    def set_event_time(self, host: str, time_nano: int) -> None:
+        self.last_event_times[host] = time_nano
+
+    @staticmethod
+    def dns_records(state: dict) -> dict:
+        """Rebuild the subdomain to record mapping from a loaded state."""
+        return {
+            subdomain: DnsRecordSummary.from_dict(record)
+            for subdomain, record in state.get('dns_records', {}).items()
+        }
+
+    @staticmethod
+    def foreign_records(state: dict) -> dict:
+        """Rebuild the subdomain to foreign record mapping from a loaded state."""
+        return {
+            subdomain: DnsRecordSummary.from_dict(record)
+            for subdomain, record in state.get('foreign_records', {}).items()
+        }
+
+    def save(self, cf_manager) -> None:
+        """Atomically write the manager's current state."""
+        config = cf_manager.tunnel_config_cache
+        state = {
+            'format': self.FORMAT,
+            'saved_at': time.time(),
+            'zone_id': cf_manager.zone_id,
+            'tunnel_id': cf_manager.tunnel_id,
+            'domain': cf_manager.domain,
+            'tunnel_config_version': getattr(config, 'version', None),
+            'last_event_times': dict(self.last_event_times),
+            'dns_records': {
+                subdomain: DnsRecordSummary.from_record(record).to_dict()
+                for subdomain, record in cf_manager.dns_record_cache.items()
+            },
+            'foreign_records': {
+                subdomain: record.to_dict() for subdomain, record in cf_manager.ownership.foreign().items()
+            },
+        }
+
+        with self._lock:
+            directory = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(prefix='.state-', dir=directory)
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(state, f, default=str)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.path)
+            except Exception:
+                os.unlink(tmp_path)
+                raise
+        logger.debug(f"Saved state snapshot with {len(state['dns_records'])} DNS records to {self.path}")
+
+class SnapshotGroup:
+    """The Docker event positions of several shard snapshots, seen as one.
+
+    The shared event readers resume from the oldest position of any shard,
+    and a processed event advances all of them.
+    """
+
+    def __init__(self, snapshots):
+        self.snapshots = [snapshot for snapshot in snapshots if snapshot is not None]
+
+    def event_time(self, host: str):
+        times = [snapshot.event_time(host) for snapshot in self.snapshots]
+        if not times or None in times:
+            return None
+        return min(times)
+
+    def set_event_time(self, host: str, time_nano: int) -> None:
+        for snapshot in self.snapshots:
+            snapshot.set_event_time(host, time_nano)
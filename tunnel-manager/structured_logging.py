@@ -0,0 +1,178 @@
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+
+from metrics import counter
+
+TEXT_FORMAT = '%(asctime)s [%(levelname)s] %(message)s'
+TEXT_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Message kinds tracked by the rate limiter before expired ones are dropped
+MAX_RATE_KEYS = 10000
+
+LOG_MESSAGES_DROPPED = counter(
+    'tunnel_manager_log_messages_dropped_total',
+    'Log messages not written, by reason (rate_limited or queue_full).',
+    ('reason',)
+)
+
+# Attributes of every LogRecord; any other attribute was passed with `extra`
+_RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+class JsonFormatter(logging.Formatter):
+    """Format records as one JSON object per line.
+
+    Fields passed with `extra` are added to the object, so that e.g.
+    `logger.info("Creating DNS record for %s", name, extra={'subdomain': subdomain})`
+    can be filtered on `subdomain` by the log pipeline.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'thread': record.threadName,
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        if record.stack_info:
+            entry['stack'] = self.formatStack(record.stack_info)
+        return json.dumps(entry, default=str)
+
+class TextFormatter(logging.Formatter):
+    """The classic one-line format, noting how many similar messages were suppressed."""
+
+    def __init__(self):
+        super().__init__(TEXT_FORMAT, datefmt=TEXT_DATE_FORMAT)
+
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        suppressed = getattr(record, 'suppressed', 0)
+        return f"{text} ({suppressed} similar messages suppressed)" if suppressed else text
+
+class RateLimitFilter(logging.Filter):
+    """Let through at most `burst` records of a kind every `interval` seconds.
+
+    Records are of the same kind when they share logger, level, message and
+    arguments, so the same message about different containers is never
+    suppressed, while one repeated for the same container is. The number of
+    records dropped is reported as `suppressed` on the next record of that
+    kind that gets through. Records at `exempt_level` or above always pass.
+    """
+
+    def __init__(self, burst: int = 10, interval: float = 60.0, exempt_level: int = logging.CRITICAL):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self.exempt_level = exempt_level
+        # kind -> [window start, records passed, records suppressed]
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.burst <= 0 or record.levelno >= self.exempt_level:
+            return True
+        # Compare arguments by value; exceptions, for instance, are new objects every time
+        args = tuple(map(str, record.args)) if isinstance(record.args, tuple) else repr(record.args)
+        key = (record.name, record.levelno, record.msg if isinstance(record.msg, str) else id(type(record.msg)), args)
+        now = time.monotonic()
+        suppressed = 0
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                if window is None and len(self._windows) >= MAX_RATE_KEYS:
+                    self._prune(now)
+                suppressed = window[2] if window else 0
+                self._windows[key] = [now, 1, 0]
+            elif window[1] < self.burst:
+                window[1] += 1
+            else:
+                window[2] += 1
+                LOG_MESSAGES_DROPPED.inc(reason='rate_limited')
+                return False
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+    def _prune(self, now: float) -> None:
+        self._windows = {
+            key: window for key, window in self._windows.items()
+            if now - window[0] < self.interval or window[2]
+        }
+        if len(self._windows) >= MAX_RATE_KEYS:
+            self._windows = {}
+
+class BufferedQueueHandler(logging.handlers.QueueHandler):
+    """Queue records for a background writer, dropping them when the queue is full.
+
+    Only the message is formatted by the logging thread, after the level and
+    rate limit checks; timestamps, JSON encoding, tracebacks and file writes
+    are left to the writer thread.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_MESSAGES_DROPPED.inc(reason='queue_full')
+
+def configure_logging(level: str = 'INFO', log_file: str = None, json_format: bool = True,
+                      max_bytes: int = 10 * 1024 * 1024, backup_count: int = 5, rotate_when: str = None,
+                      rate_burst: int = 10, rate_interval: float = 60.0,
+                      queue_size: int = 10000) -> logging.handlers.QueueListener:
+    """Route all logging through a queue to a writer thread for stderr and `log_file`.
+
+    The log file is rotated at `max_bytes`, or on the `rotate_when` schedule
+    of TimedRotatingFileHandler (e.g. 'midnight') when given, keeping
+    `backup_count` old files. Replaces the handlers of the root logger and
+    returns the started listener, which is stopped (flushing the queue) at
+    exit.
+    """
+    formatter = JsonFormatter() if json_format else TextFormatter()
+    handlers = [logging.StreamHandler()]
+    if log_file:
+        os.makedirs(os.path.dirname(log_file) or '.', exist_ok=True)
+        if rotate_when:
+            handlers.append(logging.handlers.TimedRotatingFileHandler(
+                log_file, when=rotate_when, backupCount=backup_count, delay=True
+            ))
+        else:
+            handlers.append(logging.handlers.RotatingFileHandler(
+                log_file, maxBytes=max_bytes, backupCount=backup_count, delay=True
+            ))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.Queue(maxsize=queue_size)
+    queue_handler = BufferedQueueHandler(log_queue)
+    queue_handler.addFilter(RateLimitFilter(burst=rate_burst, interval=rate_interval))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(getattr(logging, level.upper()))
+
+    listener = logging.handlers.QueueListener(log_queue, *handlers)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -0,0 +1,289 @@
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from metrics import counter
+
+logger = logging.getLogger('dns-manager')
+
+TRACE_SPANS_DROPPED = counter(
+    'tunnel_manager_trace_spans_dropped_total',
+    'Finished spans dropped because the export queue was full or an export failed.'
+)
+
+def _new_id(length: int) -> str:
+    return f'{random.getrandbits(length * 4):0{length}x}'
+
+class Span:
+    """A timed stage of a trace, with attributes such as subdomain, action or retries."""
+
+    __slots__ = ('name', 'trace_id', 'span_id', 'parent_id', 'start_ns', 'end_ns',
+                 'attributes', 'links', 'error')
+
+    def __init__(self, name: str, trace_id: str, parent_id: str = None, attributes: dict = None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = _new_id(16)
+        self.parent_id = parent_id
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = attributes or {}
+        self.links = []
+        self.error = None
+
+    def set_attribute(self, key: str, value) -> None:
+        self.attributes[key] = value
+
+    def add_link(self, context: tuple) -> None:
+        """Link another trace, e.g. the container events a coalesced push carries."""
+        self.links.append(context)
+
+    def set_error(self, error: Exception) -> None:
+        """Mark the span as failed, for errors that are handled inside it."""
+        self.error = f"{type(error).__name__}: {str(error)}"
+
+    def context(self) -> tuple:
+        return self.trace_id, self.span_id
+
+    def to_dict(self) -> dict:
+        return {
+            'name': self.name,
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'start': datetime.fromtimestamp(self.start_ns / 1e9, timezone.utc).isoformat(timespec='microseconds'),
+            'duration_ms': round((self.end_ns - self.start_ns) / 1e6, 3),
+            'attributes': self.attributes,
+            'links': [{'trace_id': trace_id, 'span_id': span_id} for trace_id, span_id in self.links],
+            'error': self.error,
+        }
+
+class _NoopSpan:
+    """Stands in for spans while tracing is off or the trace was not sampled."""
+
+    def set_attribute(self, key: str, value) -> None:
+        pass
+
+    def add_link(self, context: tuple) -> None:
+        pass
+
+    def set_error(self, error: Exception) -> None:
+        pass
+
+    def context(self):
+        return None
+
+NOOP_SPAN = _NoopSpan()
+
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+class JsonFileExporter:
+    """Append finished spans to a file as JSON lines, rotating it at `max_bytes`."""
+
+    def __init__(self, path: str, max_bytes: int = 50 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    def export(self, spans: list) -> None:
+        with open(self.path, 'a') as f:
+            for span in spans:
+                f.write(json.dumps(span.to_dict(), default=str) + '\n')
+            size = f.tell()
+        if self.max_bytes and size >= self.max_bytes:
+            os.replace(self.path, f'{self.path}.1')
+
+def _otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+def _otlp_attributes(attributes: dict) -> list:
+    return [{'key': key, 'value': _otlp_value(value)} for key, value in attributes.items() if value is not None]
+
+class OtlpHttpExporter:
+    """Send spans to an OpenTelemetry collector as OTLP/HTTP JSON.
+
+    `endpoint` is the full traces URL, e.g. http://collector:4318/v1/traces.
+    Needs no OpenTelemetry packages.
+    """
+
+    def __init__(self, endpoint: str, service_name: str = 'cloudflared-tunnel-manager',
+                 headers: dict = None, timeout: float = 10.0):
+        self.endpoint = endpoint
+        self.service_name = service_name
+        self.headers = {'Content-Type': 'application/json', **(headers or {})}
+        self.timeout = timeout
+
+    def _span(self, span: Span) -> dict:
+        otlp_span = {
+            'traceId': span.trace_id,
+            'spanId': span.span_id,
+            'name': span.name,
+            'kind': 1,
+            'startTimeUnixNano': str(span.start_ns),
+            'endTimeUnixNano': str(span.end_ns),
+            'attributes': _otlp_attributes(span.attributes),
+            'links': [{'traceId': trace_id, 'spanId': span_id} for trace_id, span_id in span.links],
+            # Status codes: 1 = OK, 2 = ERROR
+            'status': {'code': 2, 'message': span.error} if span.error else {'code': 1},
+        }
+        if span.parent_id:
+            otlp_span['parentSpanId'] = span.parent_id
+        return otlp_span
+
+    def export(self, spans: list) -> None:
+        payload = {
+            'resourceSpans': [{
+                'resource': {'attributes': _otlp_attributes({'service.name': self.service_name})},
+                'scopeSpans': [{
+                    'scope': {'name': 'tunnel-manager'},
+                    'spans': [self._span(span) for span in spans],
+                }],
+            }]
+        }
+        request = urllib.request.Request(
+            self.endpoint, data=json.dumps(payload).encode(), headers=self.headers, method='POST'
+        )
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            response.read()
+
+class Tracer:
+    """Records spans and hands finished ones to the exporters on a background thread.
+
+    Without exporters every span is a no-op, so tracing costs nothing unless
+    configured. A fraction `sample_rate` of traces is recorded; all spans of
+    a trace share the decision made for its root span.
+    """
+
+    def __init__(self, exporters: list = None, sample_rate: float = 1.0,
+                 batch_size: int = 256, flush_interval: float = 2.0, queue_size: int = 10000):
+        self.exporters = list(exporters or [])
+        self.sample_rate = sample_rate
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._export_lock = threading.Lock()
+        self._thread = None
+        if self.exporters:
+            self._thread = threading.Thread(target=self._run, name='trace-exporter', daemon=True)
+            self._thread.start()
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        """Time the enclosed block as a child of the current span, or as a new trace."""
+        parent = _current_span.get()
+        if not self.exporters or parent is NOOP_SPAN:
+            yield NOOP_SPAN
+            return
+        if parent is None and random.random() >= self.sample_rate:
+            # Children of an unsampled root are not recorded either
+            token = _current_span.set(NOOP_SPAN)
+            try:
+                yield NOOP_SPAN
+            finally:
+                _current_span.reset(token)
+            return
+
+        span = Span(name, parent.trace_id if parent else _new_id(32), parent.span_id if parent else None, attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.set_error(e)
+            raise
+        finally:
+            span.end_ns = time.time_ns()
+            _current_span.reset(token)
+            try:
+                self._queue.put_nowait(span)
+            except queue.Full:
+                TRACE_SPANS_DROPPED.inc()
+
+    def current_span(self):
+        """Return the span of the enclosing `span` block, or a no-op span."""
+        return _current_span.get() or NOOP_SPAN
+
+    def _take_batch(self, timeout: float) -> list:
+        try:
+            batch = [self._queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _export(self, batch: list) -> None:
+        with self._export_lock:
+            for exporter in self.exporters:
+                try:
+                    exporter.export(batch)
+                except Exception as e:
+                    TRACE_SPANS_DROPPED.inc(len(batch))
+                    logger.warning("Exporting %d spans with %s failed: %s", len(batch), type(exporter).__name__, e)
+
+    def _run(self) -> None:
+        while True:
+            batch = self._take_batch(self.flush_interval)
+            if batch:
+                self._export(batch)
+
+    def flush(self) -> None:
+        """Export the spans finished so far from the calling thread."""
+        while True:
+            batch = self._take_batch(0)
+            if not batch:
+                return
+            self._export(batch)
+
+TRACER = Tracer()
+
+def configure(exporters: list, sample_rate: float = 1.0) -> Tracer:
+    """Replace the global tracer, e.g. with exporters configured from the environment."""
+    global TRACER
+    TRACER = Tracer(exporters, sample_rate=sample_rate)
+    return TRACER
+
+def span(name: str, **attributes):
+    """Time a block as a span of the global tracer; see Tracer.span."""
+    return TRACER.span(name, **attributes)
+
+def current_span():
+    return TRACER.current_span()
+
+def traced(name: str):
+    """Decorator timing each call of a function or coroutine function as a span.
+
+    The function can add attributes with `current_span().set_attribute`.
+    """
+    def decorator(function):
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await function(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator